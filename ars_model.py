@@ -1,25 +1,31 @@
 # Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
 # SPDX-License-Identifier: GPL-3.0
 
-import sys
+import os
 import config
 
-from copy import copy
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
+from dataclasses import dataclass, replace
 
-from itertools import combinations
-
-from typing import Set
+from typing import Dict, List, Optional, Set
 
 import math
+import time
 
 from ortools.sat.python import cp_model
 
+from heuristic import HeuristicBalancer
+from metrics import CycleMetrics
+
 class ObjectivePrinter(cp_model.CpSolverSolutionCallback):
-    """Print intermediate solutions."""
+    """Record intermediate solutions, print them if verbose."""
 
-    def __init__(self, solver, migration_cost, node_cpu_cost_distances, node_mem_cost_distances):
+    def __init__(self, solver, migration_cost, node_cpu_cost_distances, node_mem_cost_distances, metrics, verbose=False):
         cp_model.CpSolverSolutionCallback.__init__(self)
         self.__solver = solver
+        self.__metrics = metrics
+        self.__verbose = verbose
         self.__migration_cost = migration_cost
         self.__node_cpu_cost_distances = node_cpu_cost_distances
         self.__node_mem_cost_distances = node_mem_cost_distances
@@ -27,6 +33,10 @@ class ObjectivePrinter(cp_model.CpSolverSolutionCallback):
         self.__solution_count = 0
 
     def on_solution_callback(self):
+        self.__metrics.solution(self.WallTime(), self.ObjectiveValue())
+        if not self.__verbose:
+            return
+
         migration_cost = self.Value(self.__migration_cost)
 
         print('Solution %i, time = %f s, objective = %i, migration_cost = %i' %
@@ -42,10 +52,192 @@ class ObjectivePrinter(cp_model.CpSolverSolutionCallback):
 
             print('\t', i, mem_c, cpu_c, sep='\t')
 
+@dataclass
+class CostTable:
+    """Costs of all VMs and capacities of all nodes, calculated once per run.
+
+    The per-VM and per-node lists are indexed by the position of the VM or
+    node in ARSModel.vms and ARSModel.node_list. Memory is scaled to
+    memory_precision, cpu is given in percent of a core.
+    """
+
+    vm_memory: List[int] # memory_cost()
+    vm_memory_used: List[int] # memory actually allocated on a node
+    vm_cpu: List[int] # cpu_cost()
+    vm_migration: List[int] # migration_cost()
+
+    node_memory: List[int]
+    node_cpu: List[int]
+    node_usable: List[bool] # not in maintenance
+    # load of the VMs held in place on each node
+    node_fixed_memory: List[int]
+    node_fixed_memory_used: List[int]
+    node_fixed_cpu: List[int]
+
+    total_memory: int
+    total_cpu: int
+    total_migration: int
+    total_usable_cpu: int
+    total_usable_memory: int
+    total_nodes: int
+
+    @classmethod
+    def build(cls, node_list, vms, cfg, totals=None, fixed=()):
+        """Build the table, cluster totals are taken from totals if given.
+
+        fixed VMs are not placed, they stay on their node and only add to
+        its load.
+        """
+
+        precision = cfg.model.memory_precision
+
+        node_positions = {node.name: j for j, (_, node) in enumerate(node_list)}
+        node_fixed_memory = [0] * len(node_list)
+        node_fixed_memory_used = [0] * len(node_list)
+        node_fixed_cpu = [0] * len(node_list)
+        for vm in fixed:
+            j = node_positions.get(vm.node)
+            if j is not None:
+                node_fixed_memory[j] += vm.memory_cost() // precision
+                node_fixed_memory_used[j] += vm.memory_used // precision
+                node_fixed_cpu[j] += vm.cpu_cost()
+
+        vm_memory = [vm.memory_cost() // precision for _, vm in vms]
+        vm_cpu = [vm.cpu_cost() for _, vm in vms]
+        vm_migration = [vm.migration_cost() for _, vm in vms]
+
+        node_memory = [node.memory_total // precision for _, node in node_list]
+        node_cpu = [node.num_cpu * 100 for _, node in node_list]
+        node_usable = [node.id not in cfg.maintenance.nodes for _, node in node_list]
+
+        table = cls(
+            vm_memory=vm_memory,
+            vm_memory_used=[vm.memory_used // precision for _, vm in vms],
+            vm_cpu=vm_cpu,
+            vm_migration=vm_migration,
+
+            node_memory=node_memory,
+            node_cpu=node_cpu,
+            node_usable=node_usable,
+            node_fixed_memory=node_fixed_memory,
+            node_fixed_memory_used=node_fixed_memory_used,
+            node_fixed_cpu=node_fixed_cpu,
+
+            total_memory=sum(vm_memory) + sum(node_fixed_memory),
+            total_cpu=sum(vm_cpu) + sum(node_fixed_cpu),
+            total_migration=sum(vm_migration),
+            total_usable_cpu=sum(c for c, usable in zip(node_cpu, node_usable) if usable),
+            total_usable_memory=sum(m for m, usable in zip(node_memory, node_usable) if usable),
+            total_nodes=len(node_list),
+        )
+
+        # a part of the cluster is balanced towards the targets of the whole cluster
+        if totals is not None:
+            table.total_memory = totals.total_memory
+            table.total_cpu = totals.total_cpu
+            table.total_usable_cpu = totals.total_usable_cpu
+            table.total_usable_memory = totals.total_usable_memory
+            table.total_nodes = totals.total_nodes
+
+        return table
+
+    def capacity(self, j):
+        """Memory left on node j for the placed VMs."""
+
+        return max(self.node_memory[j] - self.node_fixed_memory_used[j], 0)
+
+    def target(self, j):
+        """Cpu and memory costs the placed VMs on node j should add up to according to its share of the usable cluster."""
+
+        # TODO: FIXME: STARTHERE
+        # make calculation clearer
+        # calculate cluster fraction
+        # calculate node fraction from that
+
+        # with every node in maintenance no node has a share
+        node_cpu_fraction = self.node_cpu[j] / self.total_usable_cpu if self.total_usable_cpu else 0
+        node_mem_fraction = self.node_memory[j] / self.total_usable_memory if self.total_usable_memory else 0
+
+        # the VMs held in place already carry a part of it
+        node_cpu_target_fraction = math.ceil(self.total_cpu * node_cpu_fraction) - self.node_fixed_cpu[j]
+        node_mem_target_fraction = math.ceil(self.total_memory * node_mem_fraction) - self.node_fixed_memory[j]
+
+        return node_cpu_fraction, node_mem_fraction, node_cpu_target_fraction, node_mem_target_fraction
+
+@dataclass
+class MigrationLimits:
+    """Limits of the plan of a single cycle, None if unlimited.
+
+    Memory is scaled to memory_precision, inbound and outbound hold one
+    limit per node position.
+    """
+
+    migrations: Optional[int]
+    memory: Optional[int]
+    inbound: Optional[List[int]]
+    outbound: Optional[List[int]]
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.migrations, self.memory, self.inbound, self.outbound))
+
+@dataclass
+class Problem:
+    """A built CP-SAT model together with the variables needed to read a solution."""
+
+    model: cp_model.CpModel
+    x: Dict
+    migration_cost: cp_model.IntVar
+    node_cpu_cost_distances: List
+    node_mem_cost_distances: List
+    balance: cp_model.LinearExpr
+    classes: Dict # first VM position -> positions of interchangeable VMs
+
+def model_size(model):
+    proto = model.Proto()
+    return len(proto.variables), len(proto.constraints)
+
+def _solve_component(nodes, vms, cfg, totals, hint, fixed=()):
+    # runs in a worker process, only the placement is sent back
+    result = ARSModel(nodes, cfg, vms=vms, totals=totals, fixed=fixed).calculate_balanced_state(hint)
+    if result is None:
+        return None
+    return {vm.id: node.name for node in result for vm in node.virtual_machines}
+
 class ARSModel:
-    def __init__(self, nodes, cfg):
+    # coefficients of the cpu distances, memory distances and migration
+    # costs in the objective per mode, scaled by [model.weights]
+    OBJECTIVE_COEFFICIENTS = {
+        config.ObjectiveMode.SQUARED: (5000000, 5000, 1),
+        # same cpu to memory ratio as with squared distances, piecewise
+        # squares are divided by their bound and on the scale of distances
+        config.ObjectiveMode.PIECEWISE: (32, 1, 1),
+        config.ObjectiveMode.L1: (32, 1, 1),
+        config.ObjectiveMode.MINMAX: (32, 1, 1),
+    }
+
+    def __init__(self, nodes, cfg, vms=None, totals=None, metrics=None, fixed=()):
+        """Model the placement of VMs on nodes.
+
+        By default all VMs on the given nodes are placed. A part of a cluster
+        is modelled by passing its VMs, which may currently run on other
+        nodes, and the cost table of the whole cluster as totals. fixed VMs
+        stay where they are, their load is a constant of their node.
+        """
+
         self.nodes = nodes
         self.cfg = cfg
+        self.metrics = metrics if metrics is not None else CycleMetrics()
+
+        # positions of nodes and VMs in the cost table
+        self.node_list = list(self.all_nodes)
+        self.vms = list(self.all_vms) if vms is None else [(vm.internal_id, vm) for vm in vms]
+        self.fixed = list(fixed)
+        self.costs = CostTable.build(self.node_list, self.vms, cfg, totals, self.fixed)
+
+        # node positions each VM may be placed on
+        self.candidates = self.candidate_nodes()
+        self.limits = self.migration_limits()
 
     @property
     def all_nodes(self):
@@ -76,84 +268,897 @@ class ARSModel:
 
     @property
     def num_vms(self):
-        return sum([len(node.virtual_machines) for _, node in self.all_nodes])
+        return len(self.vms)
 
     def vms_with_connector_ids(self, ids: Set):
-        for node in self.nodes:
-            for vm in node.virtual_machines:
-                if vm.id in ids:
-                    yield (vm.internal_id, vm)
+        for vm_id, vm in self.vms:
+            if vm.id in ids:
+                yield (vm_id, vm)
 
     @property
     def total_memory_costs(self):
-        return sum(vm.memory_cost() // self.cfg.model.memory_precision for _, vm in self.all_vms)
+        return self.costs.total_memory
 
     @property
     def total_cpu_costs(self):
-        return sum(vm.cpu_cost() for _, vm in self.all_vms)
+        return self.costs.total_cpu
 
     @property
     def total_migration_costs(self):
         # TODO: handle memory_precision
-        return sum(vm.migration_cost() for _, vm in self.all_vms)
+        return self.costs.total_migration
 
     @property
     def total_usable_cluster_cpu(self):
-        return sum(node.num_cpu * 100 for _, node in self.all_nodes if node.id not in self.cfg.maintenance.nodes)
+        return self.costs.total_usable_cpu
 
     @property
     def total_usable_cluster_memory(self):
-        return sum(node.memory_total // self.cfg.model.memory_precision for _, node in self.all_nodes if node.id not in self.cfg.maintenance.nodes)
+        return self.costs.total_usable_memory
+
+
+    def placement_hint(self, previous=None):
+        """Map every VM to the node it should initially be placed on.
+
+        This is the current placement, unless a previous result holds a node
+        for the VM which still exists.
+        """
+
+        placement = {vm.id: vm.node for _, vm in self.vms}
+
+        if previous is not None:
+            node_names = {node.name for _, node in self.all_nodes}
+            for node in previous:
+                if node.name not in node_names:
+                    continue
+
+                for vm in node.virtual_machines:
+                    if vm.id in placement:
+                        placement[vm.id] = node.name
+
+        return placement
+
+    def migration_limits(self):
+        """Limits of the plan from [migration], raised to fit the VMs which have to move anyway."""
+
+        cfg = self.cfg.migration
+        costs = self.costs
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+        vm_positions = {vm.id: i for i, (_, vm) in enumerate(self.vms)}
+        current = [node_positions.get(vm.node) for _, vm in self.vms]
+
+        # VMs which cannot stay on their current node, e.g. in maintenance
+        forced = {i for i in range(len(self.vms)) if current[i] not in self.candidates[i]}
+        forced_inbound = [0] * len(self.node_list)
+        gathered = set()
+
+        # split keep-together groups gather on the allowed node most of them are on already
+        for members in self.keep_together_groups():
+            allowed = set.intersection(*(set(self.candidates[i]) for i in members))
+            staying = [i for i in members if current[i] in allowed]
+            if len({current[i] for i in members}) == 1 and len(staying) == len(members):
+                continue
+
+            counts = {}
+            for i in staying:
+                counts[current[i]] = counts.get(current[i], 0) + 1
+            target = max(counts, key=counts.get) if counts else min(allowed, default=None)
+            moving = [i for i in members if current[i] != target]
+            forced.update(moving)
+            if target is not None:
+                forced_inbound[target] += len(moving)
+                gathered.update(moving)
+
+        # all but one VM of a keep-apart rule sharing a node move
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if not rule.enabled or rule.type_ != config.Vm2VmAffinityType.KEEP_APART:
+                continue
+
+            seen = set()
+            for i in sorted(vm_positions[vm_id] for vm_id in rule.virtual_machines if vm_id in vm_positions):
+                if i in forced:
+                    continue
+                if current[i] in seen:
+                    forced.add(i)
+                seen.add(current[i])
+
+        forced_outbound = [0] * len(self.node_list)
+        for i in forced:
+            if current[i] is not None:
+                forced_outbound[current[i]] += 1
+
+        limits = MigrationLimits(migrations=None, memory=None, inbound=None, outbound=None)
+        if cfg.max_migrations_per_cycle > 0:
+            limits.migrations = max(cfg.max_migrations_per_cycle, len(forced))
+        if cfg.max_memory_per_cycle > 0:
+            limits.memory = max(cfg.max_memory_per_cycle // self.cfg.model.memory_precision,
+                                sum(costs.vm_memory_used[i] for i in forced))
+        if cfg.max_inbound_per_node > 0:
+            limits.inbound = [max(cfg.max_inbound_per_node, n) for n in forced_inbound]
+
+            # every other forced VM needs room on one of its candidates, the
+            # VMs with the fewest candidates take theirs first
+            arriving = list(forced_inbound)
+            for i in sorted(forced - gathered, key=lambda i: len(self.candidates[i])):
+                if not self.candidates[i]:
+                    continue
+
+                j = max(self.candidates[i], key=lambda j: limits.inbound[j] - arriving[j])
+                arriving[j] += 1
+                limits.inbound[j] = max(limits.inbound[j], arriving[j])
+        if cfg.max_outbound_per_node > 0:
+            limits.outbound = [max(cfg.max_outbound_per_node, n) for n in forced_outbound]
+
+        if limits.enabled and forced:
+            print(len(forced), 'VMs have to move regardless of the migration limits')
+
+        return limits
+
+    def node_loads(self, placement=None):
+        """Cpu and memory costs per node position of a placement (VM id -> node name), by default the current one."""
+
+        costs = self.costs
+
+        cpu = [0] * len(self.node_list)
+        mem = [0] * len(self.node_list)
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+        for i, (_, vm) in enumerate(self.vms):
+            j = node_positions.get(placement[vm.id] if placement is not None else vm.node)
+            if j is not None:
+                cpu[j] += costs.vm_cpu[i]
+                mem[j] += costs.vm_memory[i]
+
+        return cpu, mem
+
+    def node_deviations(self, placement=None):
+        """(cpu, memory) distance of every node position to its targets as fractions of the cluster, positive if overloaded."""
+
+        costs = self.costs
+        cpu, mem = self.node_loads(placement)
+
+        deviations = []
+        for j in range(len(self.node_list)):
+            _, _, node_cpu_target_fraction, node_mem_target_fraction = costs.target(j)
+            deviations.append(((cpu[j] - node_cpu_target_fraction) / max(1, costs.total_cpu),
+                               (mem[j] - node_mem_target_fraction) / max(1, costs.total_memory)))
+
+        return deviations
+
+    def placement_objective(self, placement):
+        """Objective of a placement in the configured mode, piecewise squares are taken exactly (divided by their bound)."""
+
+        costs = self.costs
+        mode = self.cfg.model.objective
+        cpu_weight, mem_weight, migration_weight = self.objective_weights()
+        cpu, mem = self.node_loads(placement)
+
+        cpu_distances = []
+        mem_distances = []
+        for j in range(len(self.node_list)):
+            _, _, node_cpu_target_fraction, node_mem_target_fraction = costs.target(j)
+            cpu_distances.append(abs(cpu[j] - node_cpu_target_fraction))
+            mem_distances.append(abs(mem[j] - node_mem_target_fraction))
+
+        if mode == config.ObjectiveMode.SQUARED:
+            balance = sum(d**2 for d in cpu_distances) * cpu_weight + sum(d**2 for d in mem_distances) * mem_weight
+        elif mode == config.ObjectiveMode.PIECEWISE:
+            balance = (sum(d**2 for d in cpu_distances) / max(1, costs.total_cpu) * cpu_weight
+                       + sum(d**2 for d in mem_distances) / max(1, costs.total_memory) * mem_weight)
+        elif mode == config.ObjectiveMode.MINMAX:
+            balance = max(cpu_distances, default=0) * cpu_weight + max(mem_distances, default=0) * mem_weight
+        else:
+            balance = sum(cpu_distances) * cpu_weight + sum(mem_distances) * mem_weight
+
+        migration = sum(costs.vm_migration[i] for i, (_, vm) in enumerate(self.vms) if placement[vm.id] != vm.node)
+        return balance + migration * migration_weight
+
+    def placement_violations(self, placement):
+        """Number of hard constraints a placement breaks and the names of the nodes involved.
+
+        VMs outside their candidates (e.g. on maintenance nodes), nodes out
+        of memory, split keep-together groups and keep-apart rules with two
+        VMs on one node count. A VM outside its candidates also brings its
+        most underloaded candidate, so that it has somewhere to go.
+        """
+
+        costs = self.costs
+        node_names = [node.name for _, node in self.node_list]
+        node_positions = {name: j for j, name in enumerate(node_names)}
+
+        count = 0
+        nodes = set()
+        rank = None
+        memory = [0] * len(self.node_list)
+        for i, (_, vm) in enumerate(self.vms):
+            j = node_positions.get(placement[vm.id])
+            if j is not None:
+                memory[j] += costs.vm_memory_used[i]
+            if j in self.candidates[i]:
+                continue
+
+            count += 1
+            if j is not None:
+                nodes.add(node_names[j])
+            if self.candidates[i]:
+                if rank is None:
+                    rank = {j: r for r, j in enumerate(self.destination_ranking(placement))}
+                nodes.add(node_names[min(self.candidates[i], key=rank.get)])
+
+        for j, used in enumerate(memory):
+            if used > costs.capacity(j):
+                count += 1
+                nodes.add(node_names[j])
+
+        for members in self.keep_together_groups():
+            planned = {placement[self.vms[i][1].id] for i in members}
+            if len(planned) > 1:
+                count += 1
+                nodes |= planned & set(node_names)
+
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if not rule.enabled or rule.type_ != config.Vm2VmAffinityType.KEEP_APART:
+                continue
+
+            planned = [placement[vm.id] for _, vm in self.vms_with_connector_ids(rule.virtual_machines)]
+            shared = {name for name in planned if planned.count(name) > 1}
+            if shared:
+                count += 1
+                nodes |= shared & set(node_names)
+
+        return count, nodes
+
+    def destination_ranking(self, placement=None):
+        """Node positions ordered from the most underloaded to the most overloaded node."""
+
+        deviations = self.node_deviations(placement)
+        return sorted(range(len(self.node_list)), key=lambda j: sum(deviations[j]))
+
+    def keep_together_groups(self):
+        """VM positions which have to run on the same node, overlapping keep-together rules merged."""
+
+        vm_positions = {vm.id: i for i, (_, vm) in enumerate(self.vms)}
+        parent = list(range(len(self.vms)))
 
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        ruled = set()
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if not rule.enabled or rule.type_ != config.Vm2VmAffinityType.KEEP_TOGETHER:
+                continue
+
+            members = [vm_positions[vm_id] for vm_id in rule.virtual_machines if vm_id in vm_positions]
+            ruled.update(members)
+            for i in members[1:]:
+                parent[find(i)] = find(members[0])
+
+        groups = {}
+        for i in sorted(ruled):
+            groups.setdefault(find(i), []).append(i)
+        return list(groups.values())
+
+    def candidate_nodes(self):
+        """Calculate the node positions each VM may be placed on, indexed by VM position.
+
+        Maintenance nodes, locks, vm-to-host rules and nodes which cannot fit
+        the VM at all are ruled out. VMs of a keep-together rule share the
+        intersection of their candidates. If max_candidate_nodes is set, every
+        other VM is limited to its current node and the most underloaded
+        remaining candidates.
+        """
+
+        costs = self.costs
+
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+        vm_positions = {vm.id: i for i, (_, vm) in enumerate(self.vms)}
+
+        usable = {j for j in range(len(self.node_list)) if costs.node_usable[j]}
+        allowed = [set(usable) for _ in self.vms]
+
+        # vm-to-host affinity
+        for rule in self.cfg.affinity_rules.vm_to_host:
+            if not rule.enabled: # skip disabled rules
+                continue
+
+            rule_nodes = {node_positions[name] for name in rule.nodes if name in node_positions}
+            for vm_id in rule.virtual_machines:
+                if vm_id not in vm_positions:
+                    continue
+
+                if rule.type_ == config.Vm2HostAffinityType.RUN_HERE:
+                    allowed[vm_positions[vm_id]] &= rule_nodes
+                elif rule.type_ == config.Vm2HostAffinityType.RUN_ELSEWHERE:
+                    allowed[vm_positions[vm_id]] -= rule_nodes
+
+        for i, (_, vm) in enumerate(self.vms):
+            # pin locked VMs to their current nodes
+            if vm.locked:
+                allowed[i] &= {node_positions.get(vm.node)}
+
+            # a node must at least fit the VM on its own
+            allowed[i] = {j for j in allowed[i] if costs.vm_memory_used[i] <= costs.capacity(j)}
+
+        # rules with members held in place keep the others away from or next to them
+        fixed_nodes = {vm.id: node_positions.get(vm.node) for vm in self.fixed}
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            pinned = {fixed_nodes[vm_id] for vm_id in rule.virtual_machines if vm_id in fixed_nodes}
+            if not rule.enabled or not pinned:
+                continue
+
+            for vm_id in rule.virtual_machines:
+                if vm_id not in vm_positions:
+                    continue
+
+                if rule.type_ == config.Vm2VmAffinityType.KEEP_APART:
+                    allowed[vm_positions[vm_id]] -= pinned
+                elif rule.type_ == config.Vm2VmAffinityType.KEEP_TOGETHER:
+                    allowed[vm_positions[vm_id]] &= pinned
+
+        # VMs which have to be kept together can only go where all of them
+        # can go, rules sharing a VM form one group
+        grouped = set()
+        for members in self.keep_together_groups():
+            shared = set.intersection(*(allowed[i] for i in members))
+            for i in members:
+                allowed[i] = shared
+            grouped.update(members)
+
+        # trade optimality for model size by only considering the best destinations
+        k = self.cfg.model.max_candidate_nodes
+        if k > 0:
+            ranking = self.destination_ranking()
+            for i, (_, vm) in enumerate(self.vms):
+                if i in grouped or len(allowed[i]) <= k:
+                    continue
+
+                current = node_positions.get(vm.node)
+                limited = {current} & allowed[i]
+                for j in ranking:
+                    if len(limited) >= k:
+                        break
+                    if j in allowed[i]:
+                        limited.add(j)
+
+                allowed[i] = limited
+
+        return [sorted(candidates) for candidates in allowed]
+
+    def allowed_nodes(self):
+        """Node names every VM id may be placed on, the candidates as names."""
+
+        return {vm.id: {self.node_list[j][1].name for j in self.candidates[i]} for i, (_, vm) in enumerate(self.vms)}
+
+    def components(self):
+        """Split the cluster into parts which do not share any constraint.
+
+        Nodes and VMs are connected by candidate pairs and VMs by vm-to-vm
+        rules. As the node targets are constants, every part can be solved
+        on its own. Returns a list of (node positions, VM positions), nodes
+        without any candidate VM are left out.
+        """
+
+        num_nodes = len(self.node_list)
+        vm_positions = {vm.id: i for i, (_, vm) in enumerate(self.vms)}
+
+        # union find over nodes 0..num_nodes-1 followed by the VMs
+        parent = list(range(num_nodes + len(self.vms)))
+
+        def find(a):
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
+
+        def union(a, b):
+            parent[find(a)] = find(b)
+
+        for i, candidates in enumerate(self.candidates):
+            for j in candidates:
+                union(num_nodes + i, j)
+
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if not rule.enabled:
+                continue
+
+            members = [vm_positions[vm_id] for vm_id in rule.virtual_machines if vm_id in vm_positions]
+            for i in members[1:]:
+                union(num_nodes + members[0], num_nodes + i)
+
+        groups = {}
+        for a in range(len(parent)):
+            groups.setdefault(find(a), []).append(a)
+
+        components = []
+        for members in groups.values():
+            vm_members = [a - num_nodes for a in members if a >= num_nodes]
+            if vm_members:
+                components.append(([a for a in members if a < num_nodes], vm_members))
+
+        return components
+
+    def symmetry_classes(self):
+        """Interchangeable VMs and nodes as lists of positions, classes of one are left out.
+
+        VMs are interchangeable if they have the same costs, current node and
+        candidates and are not part of a vm-to-vm rule. Nodes are if they
+        have the same capacity, no VM runs on them and they are a candidate
+        of the same VMs.
+        """
+
+        costs = self.costs
+
+        ruled = set()
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if rule.enabled:
+                ruled.update(rule.virtual_machines)
+
+        vm_classes = {}
+        for i, (_, vm) in enumerate(self.vms):
+            if vm.id in ruled or len(self.candidates[i]) < 2:
+                continue
 
-    def calculate_balanced_state(self):
-        """Solve the assignment problem."""
+            key = (costs.vm_cpu[i], costs.vm_memory[i], costs.vm_memory_used[i], costs.vm_migration[i],
+                   vm.node, tuple(self.candidates[i]))
+            vm_classes.setdefault(key, []).append(i)
 
+        node_vms = [[] for _ in self.node_list]
+        for i, candidates in enumerate(self.candidates):
+            for j in candidates:
+                node_vms[j].append(i)
+
+        occupied = {vm.node for _, vm in self.vms} | {vm.node for vm in self.fixed}
+        node_classes = {}
+        for j, (_, node) in enumerate(self.node_list):
+            if node.name in occupied or not node_vms[j]:
+                continue
+
+            key = (costs.node_memory[j], costs.node_cpu[j], tuple(node_vms[j]))
+            node_classes.setdefault(key, []).append(j)
+
+        return ([members for members in vm_classes.values() if len(members) > 1],
+                [members for members in node_classes.values() if len(members) > 1])
+
+    def canonical_placement(self, placement, node_classes):
+        """Permute a placement between interchangeable nodes so that it satisfies the symmetry breaking constraints."""
+
+        placement = dict(placement)
+        node_names = [node.name for _, node in self.node_list]
+
+        by_node = {}
+        for i, (_, vm) in enumerate(self.vms):
+            by_node.setdefault(placement[vm.id], []).append(i)
+
+        # hand the contents of interchangeable nodes out by descending memory
+        for members in node_classes:
+            contents = [by_node.get(node_names[j], []) for j in members]
+            contents.sort(key=lambda vms: sum(self.costs.vm_memory[i] for i in vms), reverse=True)
+            for j, vms in zip(members, contents):
+                for i in vms:
+                    placement[self.vms[i][1].id] = node_names[j]
+
+        return placement
+
+    def objective_weights(self, mode=None):
+        """Integer coefficients of the cpu distances, memory distances and migration costs."""
+
+        mode = mode or self.cfg.model.objective
+        cpu, memory, migration = self.OBJECTIVE_COEFFICIENTS[mode]
+        if mode == config.ObjectiveMode.MINMAX: # the largest distance stands for all nodes of the cluster
+            cpu, memory = cpu * self.costs.total_nodes, memory * self.costs.total_nodes
+
+        # only the ratios of the weights matter, the smallest one keeps the coefficient
+        weights = self.cfg.model.weights
+        weights = (weights.cpu, weights.memory, weights.migration)
+        smallest = min((w for w in weights if w > 0), default=1)
+
+        return tuple(round(c * w / smallest) for c, w in zip((cpu, memory, migration), weights))
+
+    def calculate_heuristic_state(self, hint=None):
+        """Place all VMs with the greedy/local search heuristic, None if it finds no feasible placement."""
+
+        with self.metrics.phase('heuristic'):
+            balancer = HeuristicBalancer(self)
+            result = balancer.calculate_balanced_state(hint, self.cfg.solver.heuristic_time_in_seconds)
+
+        if result is not None:
+            self.metrics.set('heuristic_objective', balancer.objective())
+        return result
+
+    def calculate_partitioned_state(self, hint=None):
+        """Solve every independent part of the cluster in its own process, None if any part has no solution."""
+
+        components = self.components()
+        print('solving', len(components), 'independent components')
+
+        # parts on a single node have nothing to decide, their VMs only have to fit
+        placement = {}
+        jobs = []
+        failed = []
+        for node_positions, vm_positions in components:
+            vms = [self.vms[i][1] for i in vm_positions]
+            if not node_positions: # no node left for any of these VMs
+                failed.append(vms)
+            elif len(node_positions) == 1:
+                node = self.node_list[node_positions[0]][1]
+                node_placement = {vm.id: node.name for vm in vms}
+                fixed = [vm for vm in self.fixed if vm.node == node.name]
+                if ARSModel([node], self.cfg, vms=vms, totals=self.costs, fixed=fixed).is_feasible(node_placement):
+                    placement.update(node_placement)
+                else:
+                    failed.append(vms)
+            else:
+                jobs.append(([self.node_list[j][1] for j in node_positions], vms))
+
+        # split the time budget so that all parts finish within it
+        num_workers = self.cfg.solver.partition_workers or os.cpu_count() or 1
+        total_vms = sum(len(vms) for _, vms in jobs)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = []
+            for nodes, vms in jobs:
+                cfg = deepcopy(self.cfg)
+                cfg.solver.partition = False
+                if len(jobs) > num_workers:
+                    share = num_workers * len(vms) / total_vms
+                    cfg.solver.max_time_in_seconds = max(1, math.floor(cfg.solver.max_time_in_seconds * share))
+                node_names = {node.name for node in nodes}
+                fixed = [vm for vm in self.fixed if vm.node in node_names]
+                futures.append(executor.submit(_solve_component, nodes, vms, cfg, self.costs, hint, fixed))
+
+            for (_, vms), future in zip(jobs, futures):
+                component_placement = future.result()
+                if component_placement is None:
+                    failed.append(vms)
+                else:
+                    placement.update(component_placement)
+
+        # a part without a solution would leave its VMs where they may not stay
+        if failed:
+            for vms in failed:
+                print('no solution for the component of VMs', sorted(vm.id for vm in vms))
+            return None
+
+        result = []
+        for _, node in self.node_list:
+            node_ = copy(node)
+            node_.virtual_machines = [vm for _, vm in self.vms if placement[vm.id] == node.name]
+            result.append(node_)
+
+        return result
+
+    def calculate_evacuation_state(self, hint=None):
+        """Move the VMs off the maintenance nodes, every other VM stays where it is.
+
+        Only the evacuated VMs are placed, by the heuristic and for up to
+        evacuate_time_in_seconds by CP-SAT starting from its placement. The
+        migration limits per cycle do not apply.
+        """
+
+        maintenance = {node.name for _, node in self.maintenance_nodes}
+        leaving = [vm for _, vm in self.vms if vm.node in maintenance]
+        staying = [vm for _, vm in self.vms if vm.node not in maintenance]
+        print('evacuating', len(leaving), 'VMs from', len(maintenance), 'maintenance nodes')
+
+        placement = {}
+        if leaving:
+            cfg = deepcopy(self.cfg)
+            cfg.solver.partition = False
+            cfg.migration.max_migrations_per_cycle = 0
+            cfg.migration.max_memory_per_cycle = 0
+            cfg.migration.max_inbound_per_node = 0
+            cfg.migration.max_outbound_per_node = 0
+            if cfg.maintenance.evacuate_time_in_seconds > 0:
+                cfg.solver.engine = config.SolverEngine.CP_SAT
+                cfg.solver.max_time_in_seconds = cfg.maintenance.evacuate_time_in_seconds
+                cfg.solver.heuristic_hint = True
+            else:
+                cfg.solver.engine = config.SolverEngine.HEURISTIC
+
+            ars = ARSModel(self.nodes, cfg, vms=leaving, totals=self.costs, metrics=self.metrics, fixed=staying + self.fixed)
+            result = ars.calculate_balanced_state(hint)
+            if result is None:
+                return None
+            placement = {vm.id: node.name for node in result for vm in node.virtual_machines}
+
+        result = []
+        for _, node in self.node_list:
+            node_ = copy(node)
+            node_.virtual_machines = [vm for _, vm in self.vms if placement.get(vm.id, vm.node) == node.name]
+            result.append(node_)
+
+        return result
+
+    def neighbourhood_limits(self, ars, placement, movable):
+        """Migration limits of a model of a part of the cluster (ars), less what the placement of the other VMs uses up.
+
+        movable holds the ids of the VMs placed by ars.
+        """
+
+        limits = self.limits
+        if not limits.enabled:
+            return ars.limits
+
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+        moved = [i for i, (_, vm) in enumerate(self.vms) if vm.id not in movable and placement[vm.id] != vm.node]
+
+        arriving = [0] * len(self.node_list)
+        leaving = [0] * len(self.node_list)
+        for i in moved:
+            vm = self.vms[i][1]
+            arriving[node_positions[placement[vm.id]]] += 1
+            if vm.node in node_positions:
+                leaving[node_positions[vm.node]] += 1
+
+        part = [node_positions[node.name] for _, node in ars.node_list]
+        result = MigrationLimits(migrations=None, memory=None, inbound=None, outbound=None)
+        if limits.migrations is not None:
+            result.migrations = max(limits.migrations - len(moved), 0)
+        if limits.memory is not None:
+            result.memory = max(limits.memory - sum(self.costs.vm_memory_used[i] for i in moved), 0)
+        if limits.inbound is not None:
+            result.inbound = [max(limits.inbound[j] - arriving[j], 0) for j in part]
+        if limits.outbound is not None:
+            result.outbound = [max(limits.outbound[j] - leaving[j], 0) for j in part]
+
+        return result
+
+    def calculate_incremental_state(self, hint=None):
+        """Rebalance the nodes furthest from their targets, a few at a time (large neighbourhood search).
+
+        Every round takes the incremental_nodes nodes furthest from their
+        targets, half of them the most overloaded and half the most
+        underloaded ones, and the nodes involved in broken hard constraints
+        (e.g. maintenance nodes still holding VMs). Only the VMs planned on
+        them are placed, between these nodes, all other VMs are fixed where
+        the plan has them. A round is kept if it breaks fewer constraints or
+        as many with a lower objective, otherwise the next round doubles
+        the number of nodes, up to four times incremental_nodes (all nodes
+        while constraints are broken). Rounds repeat until
+        max_time_in_seconds is used up or the largest neighbourhood found
+        nothing better. Returns None if the plan still breaks constraints.
+        """
+
+        deadline = time.monotonic() + self.cfg.solver.max_time_in_seconds
+
+        plan = self.placement_hint(hint)
+        if hint is not None and not self.is_feasible(plan):
+            plan = self.placement_hint()
+
+        cfg = deepcopy(self.cfg)
+        cfg.solver.incremental = False
+        cfg.solver.partition = False
+
+        node_names = [node.name for _, node in self.node_list]
+        maintenance = {node.name for _, node in self.maintenance_nodes}
+        k = max(self.cfg.solver.incremental_nodes, 2)
+
+        # keep-together groups only move as a whole
+        together = {}
+        for members in self.keep_together_groups():
+            group = {self.vms[i][1].id for i in members}
+            for vm_id in group:
+                together[vm_id] = group
+
+        objective = self.placement_objective(plan)
+        violations, broken = self.placement_violations(plan)
+        size = k
+        rounds = 0
+        while deadline - time.monotonic() >= 1:
+            ranking = [j for j in self.destination_ranking(plan) if node_names[j] not in maintenance]
+            size = min(size, len(ranking))
+
+            chosen = ranking[:size // 2] + ranking[len(ranking) - (size - size // 2):]
+            neighbourhood = frozenset(node_names[j] for j in chosen) | broken
+
+            movable = [vm for _, vm in self.vms
+                       if all(plan[vm_id] in neighbourhood for vm_id in together.get(vm.id, {vm.id}))]
+            movable_ids = {vm.id for vm in movable}
+            # only parts of keep-together groups stay on the nodes of the neighbourhood
+            fixed = [replace(vm, node=plan[vm.id]) for _, vm in self.vms
+                     if vm.id not in movable_ids and plan[vm.id] in neighbourhood]
+
+            cfg.solver.max_time_in_seconds = max(1, min(self.cfg.solver.incremental_time_in_seconds,
+                                                        math.floor(deadline - time.monotonic())))
+            nodes = [node for _, node in self.node_list if node.name in neighbourhood]
+            ars = ARSModel(nodes, cfg, vms=movable, totals=self.costs, metrics=self.metrics, fixed=fixed + self.fixed)
+            ars.limits = self.neighbourhood_limits(ars, plan, movable_ids)
+
+            previous = []
+            for node in nodes:
+                node_ = copy(node)
+                node_.virtual_machines = [vm for vm in movable if plan[vm.id] == node.name]
+                previous.append(node_)
+
+            rounds += 1
+            print('incremental round', rounds, 'nodes', len(neighbourhood), 'VMs', len(movable), sep='\t')
+            result = ars.calculate_balanced_state(previous)
+
+            improved = False
+            if result is not None:
+                candidate = dict(plan)
+                candidate.update({vm.id: node.name for node in result for vm in node.virtual_machines})
+                candidate_objective = self.placement_objective(candidate)
+                candidate_violations, candidate_broken = self.placement_violations(candidate)
+                # repairing broken constraints comes first, whatever it costs
+                improved = (candidate_violations, candidate_objective) < (violations, objective)
+                if improved:
+                    plan, objective = candidate, candidate_objective
+                    violations, broken = candidate_violations, candidate_broken
+
+            largest = len(ranking) if broken else min(len(ranking), 4 * k)
+            if improved:
+                size = k
+            elif size >= largest:
+                break
+            else:
+                size = min(size * 2, largest)
+
+        self.metrics.set('incremental_rounds', rounds)
+        if violations:
+            print('no feasible placement found,', violations, 'constraints still broken')
+            return None
+
+        result = []
+        for _, node in self.node_list:
+            node_ = copy(node)
+            node_.virtual_machines = [vm for _, vm in self.vms if plan[vm.id] == node.name]
+            result.append(node_)
+
+        return result
+
+    def migration_counts(self, placement):
+        """Moved VM positions and the migrations into and out of every node position of a placement."""
+
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+
+        moved = [i for i, (_, vm) in enumerate(self.vms) if placement[vm.id] != vm.node]
+        inbound = [0] * len(self.node_list)
+        outbound = [0] * len(self.node_list)
+        for i in moved:
+            inbound[node_positions[placement[self.vms[i][1].id]]] += 1
+            if self.vms[i][1].node in node_positions:
+                outbound[node_positions[self.vms[i][1].node]] += 1
+
+        return moved, inbound, outbound
+
+    def limits_reached(self, placement):
+        """Whether a placement uses up any of the migration limits, i.e. they may have held it back."""
+
+        limits = self.limits
+        if not limits.enabled:
+            return False
+
+        moved, inbound, outbound = self.migration_counts(placement)
+        return ((limits.migrations is not None and len(moved) >= limits.migrations)
+                or (limits.memory is not None and sum(self.costs.vm_memory_used[i] for i in moved) >= limits.memory)
+                or (limits.inbound is not None and any(n >= limit for n, limit in zip(inbound, limits.inbound) if n))
+                or (limits.outbound is not None and any(n >= limit for n, limit in zip(outbound, limits.outbound) if n)))
+
+    def is_feasible(self, placement):
+        """Check whether a placement (VM id -> node name) satisfies all hard constraints."""
+
+        node_positions = {node.name: j for j, (_, node) in enumerate(self.node_list)}
+
+        memory = [0] * len(self.node_list)
+        for i, (_, vm) in enumerate(self.vms):
+            j = node_positions.get(placement[vm.id])
+            if j not in self.candidates[i]:
+                return False
+            memory[j] += self.costs.vm_memory_used[i]
+
+        if any(used > self.costs.capacity(j) for j, used in enumerate(memory)):
+            return False
+
+        if self.limits.enabled:
+            moved, inbound, outbound = self.migration_counts(placement)
+            limits = self.limits
+            if limits.migrations is not None and len(moved) > limits.migrations:
+                return False
+            if limits.memory is not None and sum(self.costs.vm_memory_used[i] for i in moved) > limits.memory:
+                return False
+            if limits.inbound is not None and any(n > limit for n, limit in zip(inbound, limits.inbound)):
+                return False
+            if limits.outbound is not None and any(n > limit for n, limit in zip(outbound, limits.outbound)):
+                return False
+
+        for rule in self.cfg.affinity_rules.vm_to_vm:
+            if not rule.enabled:
+                continue
+
+            rule_nodes = [placement[vm.id] for _, vm in self.vms_with_connector_ids(rule.virtual_machines)]
+            if rule.type_ == config.Vm2VmAffinityType.KEEP_APART and len(set(rule_nodes)) != len(rule_nodes):
+                return False
+            if rule.type_ == config.Vm2VmAffinityType.KEEP_TOGETHER and len(set(rule_nodes)) > 1:
+                return False
+
+        return True
+
+    def build_model(self, hint=None):
+        """Populate the CP-SAT model.
+
+        hint is an optional result of a previous run to start the search from.
+        """
+
+        costs = self.costs
+        compact = self.cfg.model.formulation == config.ModelFormulation.COMPACT
+
+        vm_classes, node_classes = [], []
+        if self.cfg.model.symmetry_breaking:
+            vm_classes, node_classes = self.symmetry_classes()
+            if vm_classes or node_classes:
+                print('symmetry breaking', len(vm_classes), 'VM classes', sum(len(c) for c in vm_classes), 'VMs',
+                      len(node_classes), 'node classes', sum(len(c) for c in node_classes), 'nodes', sep='\t')
+
+        # interchangeable VMs are modelled by their first member, which
+        # stands for all of them
+        classes = {members[0]: members for members in vm_classes}
+        merged = {i for members in vm_classes for i in members[1:]}
+
+        # VMs which may be placed on each node, as (VM position, VM id)
+        node_vms = [[] for _ in self.node_list]
+        for i, (vm_id, _) in enumerate(self.vms):
+            if i in merged:
+                continue
+            for j in self.candidates[i]:
+                node_vms[j].append((i, vm_id))
 
         model = cp_model.CpModel()
 
         ## problem definition
 
-        # x_{node, vm} = 1 if vm is assigned to node
+        # x_{node, vm} = 1 if vm is assigned to node, only created for candidate nodes,
+        # for interchangeable VMs the number of them assigned to node
         x = {}
-        for node_id, node in self.all_nodes:
-            for vm_id, vm in self.all_vms:
-                x[node_id, vm_id] = model.NewBoolVar(f'x[{node_id},{vm_id}]')
-
-        # p_{node, vm} = vm_cost -> migration penalty, keep VMs where they are if they're costly to move (sticky map)
-        p = {}
-        for node_id, node in self.all_nodes:
-            for vm_id, vm in self.all_vms:
-                p[node_id, vm_id] = model.NewIntVar(0, self.total_migration_costs, f'p[{node_id},{vm_id}]')
-                if vm.node == node.name: # vm is running on node, so keeping it there does not cost anything
-                    model.Add(p[node_id, vm_id] == 0)
-                else: # migration is defined as the same cost as running the VM
-                    model.Add(p[node_id, vm_id] == vm.migration_cost())
+        for j, (node_id, node) in enumerate(self.node_list):
+            for i, vm_id in node_vms[j]:
+                if i in classes:
+                    x[node_id, vm_id] = model.NewIntVar(0, len(classes[i]), f'n[{node_id},{vm_id}]')
+                else:
+                    x[node_id, vm_id] = model.NewBoolVar(f'x[{node_id},{vm_id}]')
+
+        if not compact:
+            # p_{node, vm} = vm_cost -> migration penalty, keep VMs where they are if they're costly to move (sticky map)
+            p = {}
+            for j, (node_id, node) in enumerate(self.node_list):
+                for i, vm_id in node_vms[j]:
+                    p[node_id, vm_id] = model.NewIntVar(0, costs.total_migration, f'p[{node_id},{vm_id}]')
+                    if self.vms[i][1].node == node.name: # vm is running on node, so keeping it there does not cost anything
+                        model.Add(p[node_id, vm_id] == 0)
+                    else: # migration is defined as the same cost as running the VM
+                        model.Add(p[node_id, vm_id] == costs.vm_migration[i])
+
+        # start the search from the current placement, which is almost always
+        # feasible and close to the optimum
+        placement = None
+        if self.cfg.solver.hint:
+            placement = self.placement_hint(hint)
+            # a previous plan may be larger than the limits allow, staying put never is
+            if self.limits.enabled and not self.is_feasible(placement):
+                placement = self.placement_hint()
+            placement = self.canonical_placement(placement, node_classes)
+            for j, (node_id, node) in enumerate(self.node_list):
+                for i, vm_id in node_vms[j]:
+                    model.AddHint(x[node_id, vm_id], sum(placement[self.vms[k][1].id] == node.name for k in classes.get(i, [i])))
 
         ## system constraints
-        # each VM is assigned to exactly one node
-        for vm_id, _ in self.all_vms:
-            model.Add(sum(x[node_id, vm_id] for node_id, _ in self.all_nodes) == 1)
+        # each VM is assigned to exactly one node, maintenance nodes, locks and
+        # vm-to-host rules are already part of the candidates
+        for i, (vm_id, vm) in enumerate(self.vms):
+            if not self.candidates[i]:
+                print('no node left for VM {} ({}), the model is infeasible'.format(vm.id, vm.name))
+                model.AddBoolOr([])
+                continue
 
-        # each node has a maximum memory capacity
-        for node_id, node in self.all_nodes:
-            # TODO: make me prettier
-            model.Add(sum( x[node_id, vm_id] * (vm.memory_used // self.cfg.model.memory_precision) for vm_id, vm in self.all_vms) <= (node.memory_total // self.cfg.model.memory_precision))
+            if i not in merged:
+                model.Add(sum(x[self.node_list[j][0], vm_id] for j in self.candidates[i]) == len(classes.get(i, [i])))
 
-        # pin locked VMs to their current nodes
-        for vm_id, vm in self.all_vms:
-            if vm.locked:
-                inverted_nodes = self.all_nodes_except({vm.node})
-                node_id, _ = next(self.nodes_with_connector_ids({vm.node}))
-                model.Add(x[node_id, vm_id] == 1)
+        # each node has a maximum memory capacity
+        for j, (node_id, node) in enumerate(self.node_list):
+            model.Add(sum(x[node_id, vm_id] * costs.vm_memory_used[i] for i, vm_id in node_vms[j]) <= costs.capacity(j))
 
         ## user constraints
-        # exclude administrator disabled nodes
-        for node_id, _ in self.maintenance_nodes:
-            # no VMs must run on this node
-            model.Add(sum(x[node_id, vm_id] for vm_id, _ in self.all_vms) == 0)
-
-
         # vm-to-vm affinity
         for rule in self.cfg.affinity_rules.vm_to_vm:
             if not rule.enabled: # skip disabled rules
@@ -161,166 +1166,367 @@ class ARSModel:
 
             # anti affinity
             if rule.type_ == config.Vm2VmAffinityType.KEEP_APART and rule.enabled:
-                rule_vms = self.vms_with_connector_ids(rule.virtual_machines)
+                rule_vms = list(self.vms_with_connector_ids(rule.virtual_machines))
 
-                # iterate over all possible combinations of the listed VMs
-                for (vm_a_id, _), (vm_b_id, _) in combinations(rule_vms, 2):
-                    for node_id, _ in self.all_nodes:
-                        model.Add((x[node_id, vm_a_id] + x[node_id, vm_b_id]) < 2)
+                # each node holds at most one of the listed VMs
+                for node_id, _ in self.node_list:
+                    model.AddAtMostOne(x[node_id, vm_id] for vm_id, _ in rule_vms if (node_id, vm_id) in x)
 
             # affinity
             elif rule.type_ == config.Vm2VmAffinityType.KEEP_TOGETHER and rule.enabled:
-                rule_vms = self.vms_with_connector_ids(rule.virtual_machines)
-
-                # iterate over all possible combinations of the listed VMs
-                for (vm_a_id, vm_a), (vm_b_id, vm_b) in combinations(rule_vms, 2):
-                    node_rules = []
-                    for node_id, _ in self.all_nodes:
-                        # check whether a node holds both VMs
-                        vms_together_on_node = model.NewBoolVar(f'node[{node_id}]_vm[{vm_a.id},{vm_b.id}]_presence')
-                        model.Add((x[node_id, vm_a_id] + x[node_id, vm_b_id]) == 2).OnlyEnforceIf(vms_together_on_node)
-                        model.Add((x[node_id, vm_a_id] + x[node_id, vm_b_id]) != 2).OnlyEnforceIf(vms_together_on_node.Not())
-                        node_rules.append(vms_together_on_node)
-
-                    # only one node might hold both VMs
-                    model.Add(sum(node_rules) == 1)
-
-        # vm-to-host anti affinity
-        for rule in self.cfg.affinity_rules.vm_to_host:
-            if not rule.enabled: # skip disabled rules
-                continue
-
-            if rule.type_ == config.Vm2HostAffinityType.RUN_ELSEWHERE:
-                for vm_id, _ in self.vms_with_connector_ids(rule.virtual_machines):
-                    for node_id, _ in self.nodes_with_connector_ids(rule.nodes):
-                        model.Add(x[node_id, vm_id] < 1)
+                rule_vms = list(self.vms_with_connector_ids(rule.virtual_machines))
+
+                # every listed VM follows the placement of its predecessor, all
+                # of them share the same candidates, a node only one of them
+                # may use is ruled out for it
+                for (vm_a_id, _), (vm_b_id, _) in zip(rule_vms, rule_vms[1:]):
+                    for node_id, _ in self.node_list:
+                        a, b = x.get((node_id, vm_a_id)), x.get((node_id, vm_b_id))
+                        if a is not None and b is not None:
+                            model.Add(b == a)
+                        elif a is not None or b is not None:
+                            model.Add((a if a is not None else b) == 0)
+
+        # moved_i = 1 if VM i leaves its current node
+        current_node_ids = {node.name: node_id for node_id, node in self.node_list}
+        moved = []
+        for i, (vm_id, vm) in enumerate(self.vms):
+            count = len(classes.get(i, [i]))
+            if i in merged: # counted by the first member of its class
+                moved.append(0)
+            elif (current_node_ids.get(vm.node), vm_id) in x:
+                moved.append(count - x[current_node_ids[vm.node], vm_id])
+            else:
+                moved.append(count)
+
+        # migration limits per cycle
+        limits = self.limits
+        if limits.migrations is not None:
+            model.Add(sum(moved) <= limits.migrations)
+        if limits.memory is not None:
+            model.Add(sum(costs.vm_memory_used[i] * moved[i] for i in range(len(self.vms))) <= limits.memory)
+        if limits.inbound is not None:
+            for j, (node_id, node) in enumerate(self.node_list):
+                model.Add(sum(x[node_id, vm_id] for i, vm_id in node_vms[j] if self.vms[i][1].node != node.name) <= limits.inbound[j])
+        if limits.outbound is not None:
+            leaving = {node.name: [] for _, node in self.node_list}
+            for i, (_, vm) in enumerate(self.vms):
+                if vm.node in leaving:
+                    leaving[vm.node].append(moved[i])
+            for j, (_, node) in enumerate(self.node_list):
+                model.Add(sum(leaving[node.name]) <= limits.outbound[j])
 
-            elif rule.type_ == config.Vm2HostAffinityType.RUN_HERE:
-                inverted_nodes = self.all_nodes_except(rule.nodes)
-                for vm_id, _ in self.vms_with_connector_ids(rule.virtual_machines):
-                    for node_id, _ in inverted_nodes:
-                        model.Add(x[node_id, vm_id] < 1)
 
         ## Objective
         # TODO: validated constraints before or tools to give meaning full error messages
         # minimize cost per node to total_cost/node_count
 
+        # loads of the nodes in the hinted placement
+        if placement is not None:
+            hint_cpu = {node.name: 0 for _, node in self.node_list}
+            hint_mem = {node.name: 0 for _, node in self.node_list}
+            for i, (_, vm) in enumerate(self.vms):
+                if placement[vm.id] in hint_cpu:
+                    hint_cpu[placement[vm.id]] += costs.vm_cpu[i]
+                    hint_mem[placement[vm.id]] += costs.vm_memory[i]
+
+        mode = self.cfg.model.objective
+        cpu_weight, mem_weight, migration_weight = self.objective_weights()
+
         node_cpu_cost_distances = []
         node_mem_cost_distances = []
-        for node_id, node in self.all_nodes:
-            mem_c = model.NewIntVar(0, self.total_memory_costs, f'total_memory_costs_of_node_{node_id}')
-            model.Add(mem_c == sum((vm.memory_cost() // self.cfg.model.memory_precision) * x[node_id, vm_id] for vm_id, vm in self.all_vms))
+        node_mem_costs = []
+        hint_objective = 0
+        for j, (node_id, node) in enumerate(self.node_list):
+            mem_c = model.NewIntVar(0, costs.total_memory, f'total_memory_costs_of_node_{node_id}')
+            model.Add(mem_c == sum(costs.vm_memory[i] * x[node_id, vm_id] for i, vm_id in node_vms[j]))
+            node_mem_costs.append(mem_c)
 
-            cpu_c = model.NewIntVar(0, self.total_cpu_costs, f'total_cpu_costs_of_node_{node_id}')
-            model.Add(cpu_c == sum((vm.cpu_cost()) * x[node_id, vm_id] for vm_id, vm in self.all_vms))
+            cpu_c = model.NewIntVar(0, costs.total_cpu, f'total_cpu_costs_of_node_{node_id}')
+            model.Add(cpu_c == sum(costs.vm_cpu[i] * x[node_id, vm_id] for i, vm_id in node_vms[j]))
 
-            # TODO: FIXME: STARTHERE
-            # make calculation clearer
-            # calculate cluster fraction
-            # calculate node fraction from that
+            node_cpu_fraction, node_mem_fraction, node_cpu_target_fraction, node_mem_target_fraction = costs.target(j)
 
-            node_cpu_fraction = (node.num_cpu * 100) / self.total_usable_cluster_cpu
-            node_mem_fraction = (node.memory_total // self.cfg.model.memory_precision) / self.total_usable_cluster_memory
+            cpu_target_fraction_distance = model.NewIntVar(-1-costs.total_cpu, costs.total_cpu, f'total_cpu_costs_of_node_{node_id}')
+            model.Add(cpu_target_fraction_distance == cpu_c - node_cpu_target_fraction)
 
-            node_cpu_target_fraction = math.ceil(self.total_cpu_costs * node_cpu_fraction)
+            mem_target_fraction_distance = model.NewIntVar(-1-costs.total_memory, costs.total_memory, f'total_mem_costs_of_node_{node_id}')
+            model.Add(mem_target_fraction_distance == mem_c - node_mem_target_fraction)
 
-            node_mem_target_fraction = math.ceil(self.total_memory_costs * node_mem_fraction)
+            if mode == config.ObjectiveMode.SQUARED:
+                cpu_target_fraction_distance_squared = model.NewIntVar(0, costs.total_cpu**2, f'total_cpu_costs_of_node_{node_id}')
+                model.AddMultiplicationEquality(cpu_target_fraction_distance_squared, cpu_target_fraction_distance, cpu_target_fraction_distance)
 
-            cpu_target_fraction_distance = model.NewIntVar(-1-self.total_cpu_costs, self.total_cpu_costs, f'total_cpu_costs_of_node_{node_id}')
-            model.Add(cpu_target_fraction_distance == cpu_c - node_cpu_target_fraction)
+                mem_target_fraction_distance_squared = model.NewIntVar(0, costs.total_memory**2, f'total_mem_costs_of_node_{node_id}')
+                model.AddMultiplicationEquality(mem_target_fraction_distance_squared, mem_target_fraction_distance, mem_target_fraction_distance)
 
-            mem_target_fraction_distance = model.NewIntVar(-1-self.total_memory_costs, self.total_memory_costs, f'total_mem_costs_of_node_{node_id}')
-            model.Add(mem_target_fraction_distance == mem_c - node_mem_target_fraction)
+                if placement is not None:
+                    hint_objective += (hint_cpu[node.name] - node_cpu_target_fraction)**2 * cpu_weight + (hint_mem[node.name] - node_mem_target_fraction)**2 * mem_weight
 
-            cpu_target_fraction_distance_squared = model.NewIntVar(0, self.total_cpu_costs**2, f'total_cpu_costs_of_node_{node_id}')
-            model.AddMultiplicationEquality(cpu_target_fraction_distance_squared, cpu_target_fraction_distance, cpu_target_fraction_distance)
+                node_cpu_cost_distances.append(cpu_target_fraction_distance_squared)
+                node_mem_cost_distances.append(mem_target_fraction_distance_squared)
+            elif mode == config.ObjectiveMode.PIECEWISE:
+                node_cpu_cost_distances.append(self._piecewise_square(model, cpu_target_fraction_distance, costs.total_cpu, f'cpu_costs_of_node_{node_id}'))
+                node_mem_cost_distances.append(self._piecewise_square(model, mem_target_fraction_distance, costs.total_memory, f'mem_costs_of_node_{node_id}'))
+            else: # l1 and minmax
+                cpu_abs = model.NewIntVar(0, costs.total_cpu + 1, f'abs_cpu_costs_of_node_{node_id}')
+                model.AddAbsEquality(cpu_abs, cpu_target_fraction_distance)
 
-            mem_target_fraction_distance_squared = model.NewIntVar(0, self.total_memory_costs**2, f'total_mem_costs_of_node_{node_id}')
-            model.AddMultiplicationEquality(mem_target_fraction_distance_squared, mem_target_fraction_distance, mem_target_fraction_distance)
+                mem_abs = model.NewIntVar(0, costs.total_memory + 1, f'abs_mem_costs_of_node_{node_id}')
+                model.AddAbsEquality(mem_abs, mem_target_fraction_distance)
 
-            node_cpu_cost_distances.append(cpu_target_fraction_distance_squared)
-            node_mem_cost_distances.append(mem_target_fraction_distance_squared)
+                node_cpu_cost_distances.append(cpu_abs)
+                node_mem_cost_distances.append(mem_abs)
 
-            print("node", "type", "lfrac", "cfrac" ,sep='\t')
-            print(node.name, "cpu", node_cpu_target_fraction, node_cpu_fraction, sep='\t')
-            print(node.name, "mem", node_mem_target_fraction, node_mem_fraction, sep='\t')
-            print()
+            if self.cfg.metrics.verbose:
+                print("node", "type", "lfrac", "cfrac" ,sep='\t')
+                print(node.name, "cpu", node_cpu_target_fraction, node_cpu_fraction, sep='\t')
+                print(node.name, "mem", node_mem_target_fraction, node_mem_fraction, sep='\t')
+                print()
+
+        # interchangeable empty nodes are filled in descending memory order
+        for members in node_classes:
+            for a, b in zip(members, members[1:]):
+                model.Add(node_mem_costs[a] >= node_mem_costs[b])
 
         # calculate migration penalty
         per_vm_migration_costs = [] # migration penalties
-        for node_id, _ in self.all_nodes:
-            for vm_id, vm in self.all_vms:
-                vm_p = model.NewIntVar(0, self.total_migration_costs, f'memory_penalty_of_vm_{vm_id}_to_{node_id}')
-                model.AddMultiplicationEquality(vm_p, [x[node_id, vm_id], p[node_id, vm_id]])
-                per_vm_migration_costs.append(vm_p)
-
+        if compact:
+            # a VM costs its migration cost unless it stays on its current node
+            for i in range(len(self.vms)):
+                per_vm_migration_costs.append(costs.vm_migration[i] * moved[i])
+        else:
+            for j, (node_id, _) in enumerate(self.node_list):
+                for _, vm_id in node_vms[j]:
+                    vm_p = model.NewIntVar(0, costs.total_migration, f'memory_penalty_of_vm_{vm_id}_to_{node_id}')
+                    model.AddMultiplicationEquality(vm_p, [x[node_id, vm_id], p[node_id, vm_id]])
+                    per_vm_migration_costs.append(vm_p)
+
+        # never part of the objective, only kept for the classic formulation
         per_node_memory_costs = []
-        for node_id, node in self.all_nodes:
-            c = model.NewIntVar(0, self.total_memory_costs, f'total_memory_costs_of_node_{node_id}')
-            model.Add(c == sum((vm.memory_cost() // self.cfg.model.memory_precision) * x[node_id, vm_id] for vm_id, vm in self.all_vms))
+        per_node_cpu_costs = []
+        if not compact:
+            for j, (node_id, node) in enumerate(self.node_list):
+                c = model.NewIntVar(0, costs.total_memory, f'total_memory_costs_of_node_{node_id}')
+                model.Add(c == sum(costs.vm_memory[i] * x[node_id, vm_id] for i, vm_id in node_vms[j]))
 
-            # (total node costs)^2
-            cs = model.NewIntVar(0, self.total_memory_costs**2, f'squared_total_costs_of_node_{node_id}')
-            model.AddMultiplicationEquality(cs, c, c)
+                # (total node costs)^2
+                cs = model.NewIntVar(0, costs.total_memory**2, f'squared_total_costs_of_node_{node_id}')
+                model.AddMultiplicationEquality(cs, c, c)
 
-            per_node_memory_costs.append(cs)
+                per_node_memory_costs.append(cs)
 
-        per_node_cpu_costs = []
-        for node_id, node in self.all_nodes:
-            c = model.NewIntVar(0, self.total_cpu_costs, f'total_cpu_costs_of_node_{node_id}')
-            model.Add(c == sum((vm.cpu_cost()) * x[node_id, vm_id] for vm_id, vm in self.all_vms))
+            for j, (node_id, node) in enumerate(self.node_list):
+                c = model.NewIntVar(0, costs.total_cpu, f'total_cpu_costs_of_node_{node_id}')
+                model.Add(c == sum(costs.vm_cpu[i] * x[node_id, vm_id] for i, vm_id in node_vms[j]))
 
-            # (total node costs)^2
-            cs = model.NewIntVar(0, self.total_cpu_costs**2, f'squared_total_costs_of_node_{node_id}')
-            model.AddMultiplicationEquality(cs, c, c)
+                # (total node costs)^2
+                cs = model.NewIntVar(0, costs.total_cpu**2, f'squared_total_costs_of_node_{node_id}')
+                model.AddMultiplicationEquality(cs, c, c)
 
-            per_node_cpu_costs.append(cs)
+                per_node_cpu_costs.append(cs)
 
 
 
         # objective
 
         # migration_cost
-        migration_cost = model.NewIntVar(0, self.total_migration_costs**2*self.num_vms, 'obj_migration_cost')
+        # no plan costs more than moving every VM
+        migration_cost = model.NewIntVar(0, costs.total_migration, 'obj_migration_cost')
         model.Add(migration_cost == sum(per_vm_migration_costs))
 
 
-        obj = model.NewIntVar(0, self.total_memory_costs**2*self.num_vms + self.total_migration_costs, 'obj')
-        model.Add(obj == sum(node_cpu_cost_distances)*5000000 + sum(node_mem_cost_distances)*5000 + migration_cost)
-
-        model.Minimize(obj)
-
-        # Solve and print out the solution.
+        if mode == config.ObjectiveMode.MINMAX:
+            # only the largest distance of each resource counts
+            max_cpu_distance = model.NewIntVar(0, costs.total_cpu + 1, 'max_cpu_distance')
+            model.AddMaxEquality(max_cpu_distance, node_cpu_cost_distances)
+            max_mem_distance = model.NewIntVar(0, costs.total_memory + 1, 'max_mem_distance')
+            model.AddMaxEquality(max_mem_distance, node_mem_cost_distances)
+            node_cpu_cost_distances = [max_cpu_distance]
+            node_mem_cost_distances = [max_mem_distance]
+
+        balance = sum(node_cpu_cost_distances)*cpu_weight + sum(node_mem_cost_distances)*mem_weight
+
+        if mode == config.ObjectiveMode.SQUARED:
+            # a feasible hint must stay within the objective's domain, otherwise it
+            # is rejected and the search starts from scratch
+            obj_upper_bound = costs.total_memory**2*self.num_vms + costs.total_migration
+            if placement is not None and self.is_feasible(placement):
+                hint_objective += sum(costs.vm_migration[i] for i, (_, vm) in enumerate(self.vms) if placement[vm.id] != vm.node) * migration_weight
+                obj_upper_bound = max(obj_upper_bound, hint_objective)
+
+            obj = model.NewIntVar(0, obj_upper_bound, 'obj')
+            model.Add(obj == balance + migration_cost*migration_weight)
+
+            model.Minimize(obj)
+        else:
+            model.Minimize(balance + migration_cost*migration_weight)
+
+        return Problem(
+            model=model,
+            x=x,
+            migration_cost=migration_cost,
+            node_cpu_cost_distances=node_cpu_cost_distances,
+            node_mem_cost_distances=node_mem_cost_distances,
+            balance=balance,
+            classes=classes,
+        )
+
+    def _piecewise_square(self, model, distance, bound, name):
+        """Lower bound distance**2/bound by tangents, denser around 0 where balanced nodes are.
+
+        Divided by bound the square stays within the range of the distance,
+        so fine memory precisions do not overflow it.
+        """
+
+        segments = self.cfg.model.piecewise_segments
+        square = model.NewIntVar(0, bound + 2, f'squared_{name}')
+        for k in range(1, segments + 1):
+            # tangent at bound*(k/segments)**2, multiplied by segments**4 to stay integral
+            slope = 2 * k**2 * segments**2
+            offset = bound * k**4
+            model.Add(segments**4 * square >= slope * distance - offset)
+            model.Add(segments**4 * square >= -slope * distance - offset)
+
+        return square
+
+    def solve(self, problem, max_time_in_seconds):
         solver = cp_model.CpSolver()
-        solver.parameters.max_time_in_seconds = self.cfg.solver.max_time_in_seconds
+        solver.parameters.max_time_in_seconds = max_time_in_seconds
         solver.parameters.num_search_workers = self.cfg.solver.num_search_workers
+        solver.parameters.repair_hint = self.cfg.solver.repair_hint
 
-        objective_printer = ObjectivePrinter(solver, migration_cost, node_cpu_cost_distances, node_mem_cost_distances)
-        status = solver.Solve(model, objective_printer)
-        print()
-        print(solver.ResponseStats())
-
-        if status == cp_model.OPTIMAL or cp_model.FEASIBLE:
-            if status == cp_model.INFEASIBLE:
-                print("INFEASIBLE :(")
-                sys.exit(1)
-            elif status == cp_model.OPTIMAL:
-                print("OPTIMAL")
-            else:
-                print("FEASIBLE")
+        # the search log tells where presolve ends
+        solver.parameters.log_search_progress = True
+        solver.parameters.log_to_stdout = False
+        solver.log_callback = self.metrics.solver_log
+
+        objective_printer = ObjectivePrinter(solver, problem.migration_cost, problem.node_cpu_cost_distances, problem.node_mem_cost_distances,
+                                             self.metrics, self.cfg.metrics.verbose)
+        status = solver.Solve(problem.model, objective_printer)
+        self.metrics.solved(solver.WallTime())
+        self.metrics.set('solver_status', solver.StatusName(status))
 
+        if self.cfg.metrics.verbose:
             print()
+            print(solver.ResponseStats())
 
-            result = []
+        return status, solver
 
-            for node_id, node in self.all_nodes:
-                node_ = copy(node)
-                node_.virtual_machines = []
-                for vm_id, vm in self.all_vms:
-                    if solver.BooleanValue(x[node_id, vm_id]): # vm has been placed on node
-                        node_.virtual_machines.append(vm)
+    def solve_staged(self, problem):
+        """Minimize the imbalance first, then the migration costs while staying within balance_tolerance of it."""
+
+        model = problem.model
+        max_time = self.cfg.solver.max_time_in_seconds
+
+        model.Minimize(problem.balance)
+        status, solver = self.solve(problem, max_time * self.cfg.solver.stage1_time_share)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return status, solver
+
+        balance = round(solver.ObjectiveValue())
+        print('stage 1', solver.StatusName(status), 'balance', balance, sep='\t')
+        self.metrics.set('stage1_balance', balance)
+
+        # continue from the complete stage 1 solution, which is feasible for stage 2
+        model.ClearHints()
+        for i in range(len(model.Proto().variables)):
+            var = model.GetIntVarFromProtoIndex(i)
+            model.AddHint(var, solver.Value(var))
+        model.Add(problem.balance <= math.floor(balance * (1 + self.cfg.solver.balance_tolerance)))
+
+        model.Minimize(problem.migration_cost)
+        status2, solver2 = self.solve(problem, max(max_time - solver.WallTime(), 1))
+        if status2 not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            print('stage 2', solver2.StatusName(status2), 'keeping stage 1 solution', sep='\t')
+            return status, solver
+
+        return status2, solver2
+
+    def calculate_balanced_state(self, hint=None):
+        """Solve the assignment problem.
+
+        hint is an optional result of a previous run to start the search from.
+        """
+
+        if self.vms and not any(self.costs.node_usable):
+            print('no node left outside maintenance')
+            return None
+
+        # the rounds account for their own build and solve times
+        if self.cfg.solver.incremental:
+            return self.calculate_incremental_state(hint)
+
+        if self.cfg.solver.engine == config.SolverEngine.HEURISTIC:
+            return self.calculate_heuristic_state(hint)
+
+        if self.cfg.solver.partition and (self.limits.migrations is not None or self.limits.memory is not None):
+            print('migration limits span the whole cluster, solving it as one model')
+        elif self.cfg.solver.partition:
+            with self.metrics.phase('solve'):
+                return self.calculate_partitioned_state(hint)
+
+        if self.cfg.solver.heuristic_hint:
+            hint = self.calculate_heuristic_state(hint) or hint
+
+        with self.metrics.phase('build'):
+            problem = self.build_model(hint)
+
+        num_variables, num_constraints = model_size(problem.model)
+        self.metrics.set('model_variables', num_variables)
+        self.metrics.set('model_constraints', num_constraints)
+        print('model', self.cfg.model.formulation.value, 'variables', num_variables, 'constraints', num_constraints, sep='\t')
+
+
+        # Solve and print out the solution.
+        if self.cfg.solver.staged:
+            status, solver = self.solve_staged(problem)
+        else:
+            status, solver = self.solve(problem, self.cfg.solver.max_time_in_seconds)
+
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            print(solver.StatusName(status), ":(")
+            if self.cfg.solver.fallback:
+                print("falling back to heuristic")
+                return self.calculate_heuristic_state(hint)
+            return None
+
+        print(solver.StatusName(status))
+        print()
+        self.metrics.set('objective', solver.ObjectiveValue())
+
+        placement = self.solution_placement(problem, solver)
+
+        result = {}
+        for _, node in self.node_list:
+            result[node.name] = copy(node)
+            result[node.name].virtual_machines = []
+
+        for _, vm in self.vms:
+            result[placement[vm.id]].virtual_machines.append(vm)
+
+        return list(result.values())
+
+    def solution_placement(self, problem, solver):
+        """Read the placement (VM id -> node name) from a solution."""
+
+        vm_positions = {vm_id: i for i, (vm_id, _) in enumerate(self.vms)}
+        node_names = {node_id: node.name for node_id, node in self.node_list}
+
+        assigned = {}
+        for (node_id, vm_id), var in problem.x.items():
+            count = solver.Value(var)
+            if count:
+                assigned.setdefault(vm_positions[vm_id], []).append((node_names[node_id], count))
 
-                result.append(node_)
+        placement = {}
+        for i, nodes in assigned.items():
+            # interchangeable VMs share their current node, they stay there first
+            current = self.vms[i][1].node
+            nodes.sort(key=lambda node: node[0] != current)
+            names = [name for name, count in nodes for _ in range(count)]
+            for k, name in zip(problem.classes.get(i, [i]), names):
+                placement[self.vms[k][1].id] = name
 
-            return result
+        return placement
 
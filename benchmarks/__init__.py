@@ -0,0 +1,2 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
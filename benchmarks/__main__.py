@@ -0,0 +1,81 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+# Run the benchmark suite over a matrix of synthetic clusters and write the
+# results as JSON, e.g. to compare two revisions for scaling regressions.
+#
+#   python -m benchmarks [--sizes 10x100 50x1000 200x20000] [--skew 0 1] [--rule-density 0 0.1] [--output bench.json]
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import ortools
+
+from benchmarks import executor, solve
+from benchmarks.model_build import default_config
+from config import ConnectionBackend, ModelFormulation, SolverEngine
+
+def parse_size(size):
+    num_nodes, num_vms = size.split('x')
+    return int(num_nodes), int(num_vms)
+
+def main():
+    parser = argparse.ArgumentParser(description='run the ARS benchmark suite')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[(10, 100), (20, 400), (50, 1000)],
+                        metavar='NODESxVMS')
+    parser.add_argument('--skew', type=float, nargs='+', default=[0.0, 1.0])
+    parser.add_argument('--rule-density', type=float, nargs='+', default=[0.0, 0.1])
+    parser.add_argument('--formulation', nargs='+', default=[f.value for f in ModelFormulation],
+                        choices=[f.value for f in ModelFormulation])
+    parser.add_argument('--max-time', type=float, default=10, help='CP-SAT time limit per run')
+    parser.add_argument('--executor-max-vms', type=int, default=2000,
+                        help='only measure migration throughput for clusters up to this size')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+
+    def record(suite, result):
+        result['suite'] = suite
+        results.append(result)
+        print(suite, *('{}={}'.format(k, v) for k, v in result.items() if k not in ('suite', 'curve')), file=sys.stderr)
+
+    for num_nodes, num_vms in args.sizes:
+        for skew in args.skew:
+            for rule_density in args.rule_density:
+                cfg = default_config()
+                cfg.solver.max_time_in_seconds = args.max_time
+
+                for formulation in args.formulation:
+                    cfg.model.formulation = ModelFormulation(formulation)
+                    record('solve', solve.measure(num_nodes, num_vms, cfg, skew, rule_density))
+
+                cfg.solver.engine = SolverEngine.HEURISTIC
+                record('solve', solve.measure(num_nodes, num_vms, cfg, skew, rule_density))
+
+        if num_vms <= args.executor_max_vms:
+            cfg = default_config()
+            cfg.solver.engine = SolverEngine.HEURISTIC
+            cfg.migration.poll_interval = 0.05
+            for backend in ConnectionBackend:
+                cfg.connection.backend = backend
+                record('executor', executor.measure(num_nodes, num_vms, cfg))
+
+    output = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'ortools': ortools.__version__,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+# Measure migration throughput of the connectors against a simulated cluster.
+#
+#   python -m benchmarks.executor [--nodes 10] [--vms 400] [--backend proxmoxer async] [--speedup 100]
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import time
+
+from ars_model import ARSModel
+from benchmarks.model_build import default_config
+from benchmarks.synthetic import generate_cluster
+from config import ConnectionBackend, SolverEngine
+from connections import pve as proxmox
+from connections import pve_async
+from connections.replay import FakeAsyncProxmoxAPI, FakeProxmoxAPI
+
+def measure(num_nodes, num_vms, cfg, skew=1.0, duration=(5.0, 30.0), failure_rate=0.0, speedup=100.0, seed=0):
+    """Migrate a skewed cluster into a balanced state and time it in simulated seconds."""
+
+    nodes = generate_cluster(num_nodes, num_vms, seed=seed, skew=skew)
+    fake = FakeProxmoxAPI.from_cluster(nodes, duration=duration, failure_rate=failure_rate, speedup=speedup, seed=seed)
+
+    if cfg.connection.backend == ConnectionBackend.ASYNC:
+        connector, pve = pve_async, FakeAsyncProxmoxAPI(fake)
+    else:
+        connector, pve = proxmox, fake
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        state = connector.fetch_current_state(pve, cfg)
+        ars = ARSModel(state, cfg)
+        new_state = ars.calculate_balanced_state()
+
+    current = {vm.id: vm for node in state for vm in node.virtual_machines}
+    migrations = [(current[vm.id], node.name) for node in new_state for vm in node.virtual_machines if current[vm.id].node != node.name]
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        failed = connector.realize_migrations(logging.getLogger(__name__), pve, migrations, cfg, nodes=state, allowed=ars.allowed_nodes())
+    elapsed = (time.perf_counter() - start) * speedup
+
+    # the lower bound if every node had all of its slots busy all the time
+    busy = {}
+    for vmid, source, target, duration, _ in fake.migrations:
+        busy[source] = busy.get(source, 0) + duration
+        busy[target] = busy.get(target, 0) + duration
+    bound = max(busy.values(), default=0) / cfg.migration.max_migrations_per_host
+
+    return {
+        'backend': cfg.connection.backend.value, 'nodes': num_nodes, 'vms': num_vms,
+        'migrations': len(migrations), 'tasks': len(fake.migrations), 'failed': len(failed),
+        'simulated_seconds': elapsed, 'bound_seconds': bound,
+        'migrations_per_hour': len(migrations) / elapsed * 3600 if elapsed else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark realize_migrations against a simulated cluster')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--vms', type=int, default=400)
+    parser.add_argument('--backend', nargs='+', default=[b.value for b in ConnectionBackend],
+                        choices=[b.value for b in ConnectionBackend])
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--speedup', type=float, default=100.0)
+    args = parser.parse_args()
+
+    cfg = default_config()
+    cfg.solver.engine = SolverEngine.HEURISTIC
+    cfg.migration.poll_interval = 0.05
+
+    for backend in args.backend:
+        cfg.connection.backend = ConnectionBackend(backend)
+        print(json.dumps(measure(args.nodes, args.vms, cfg, failure_rate=args.failure_rate, speedup=args.speedup)))
+
+if __name__ == '__main__':
+    main()
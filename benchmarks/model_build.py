@@ -0,0 +1,50 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+# Measure how long populating the CP-SAT model takes for growing clusters.
+#
+#   python -m benchmarks.model_build [--nodes 10] [--vms 100 200 400 800] [--formulation classic compact]
+
+import argparse
+import contextlib
+import io
+import time
+
+from ars_model import ARSModel, model_size
+from benchmarks.synthetic import generate_cluster
+from config import Config, General, Migration, Model, ModelFormulation, Solver
+
+def default_config():
+    return Config(general=General(host='', user='', password=''), model=Model(), solver=Solver(), migration=Migration())
+
+def measure(num_nodes, num_vms, cfg):
+    nodes = generate_cluster(num_nodes, num_vms)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # silence per node output
+        problem = ARSModel(nodes, cfg).build_model()
+    elapsed = time.perf_counter() - start
+
+    num_variables, num_constraints = model_size(problem.model)
+    return elapsed, num_variables, num_constraints
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark ARSModel.build_model')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--vms', type=int, nargs='+', default=[100, 200, 400, 800])
+    parser.add_argument('--formulation', nargs='+', default=[f.value for f in ModelFormulation],
+                        choices=[f.value for f in ModelFormulation])
+    args = parser.parse_args()
+
+    cfg = default_config()
+
+    print('formulation', 'nodes', 'vms', 'seconds', 'us/pair', 'variables', 'constraints', sep='\t')
+    for formulation in args.formulation:
+        cfg.model.formulation = ModelFormulation(formulation)
+        for num_vms in args.vms:
+            elapsed, num_variables, num_constraints = measure(args.nodes, num_vms, cfg)
+            per_pair = elapsed / (args.nodes * num_vms) * 1e6
+            print(formulation, args.nodes, num_vms, '{:.3f}'.format(elapsed), '{:.1f}'.format(per_pair), num_variables, num_constraints, sep='\t')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+# Measure model size, build and solve times and the objective over time.
+#
+#   python -m benchmarks.solve [--nodes 10] [--vms 400] [--skew 0.5] [--rule-density 0.1] [--engine cp-sat heuristic]
+
+import argparse
+import contextlib
+import io
+import json
+import time
+
+from ortools.sat.python import cp_model
+
+from ars_model import ARSModel, model_size
+from benchmarks.model_build import default_config
+from benchmarks.synthetic import generate_cluster, generate_rules
+from config import SolverEngine
+from heuristic import HeuristicBalancer
+
+class ObjectiveCurve(cp_model.CpSolverSolutionCallback):
+    """Record (seconds, objective) of every solution found."""
+
+    def __init__(self):
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.curve = []
+
+    def on_solution_callback(self):
+        self.curve.append((self.WallTime(), self.ObjectiveValue()))
+
+def solve_cp_sat(ars):
+    result = {}
+
+    start = time.perf_counter()
+    problem = ars.build_model()
+    result['build_seconds'] = time.perf_counter() - start
+    result['variables'], result['constraints'] = model_size(problem.model)
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = ars.cfg.solver.max_time_in_seconds
+    solver.parameters.num_search_workers = ars.cfg.solver.num_search_workers
+
+    curve = ObjectiveCurve()
+    status = solver.Solve(problem.model, curve)
+
+    result['status'] = solver.StatusName(status)
+    result['solve_seconds'] = solver.WallTime()
+    result['objective'] = solver.ObjectiveValue() if curve.curve else None
+    result['first_solution_seconds'] = curve.curve[0][0] if curve.curve else None
+    result['curve'] = curve.curve
+    return result
+
+def solve_heuristic(ars):
+    start = time.perf_counter()
+    balancer = HeuristicBalancer(ars)
+    placement = balancer.solve(time_limit=ars.cfg.solver.heuristic_time_in_seconds)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'status': 'FEASIBLE' if placement is not None else 'INFEASIBLE',
+        'solve_seconds': elapsed,
+        'objective': balancer.objective() if placement is not None else None,
+    }
+
+def measure(num_nodes, num_vms, cfg, skew=0.0, rule_density=0.0, seed=0):
+    nodes = generate_cluster(num_nodes, num_vms, seed=seed, skew=skew)
+    cfg.affinity_rules = generate_rules(nodes, rule_density, seed=seed)
+
+    result = {
+        'engine': cfg.solver.engine.value, 'formulation': cfg.model.formulation.value,
+        'nodes': num_nodes, 'vms': num_vms, 'skew': skew, 'rule_density': rule_density,
+        'vm_to_vm_rules': len(cfg.affinity_rules.vm_to_vm), 'vm_to_host_rules': len(cfg.affinity_rules.vm_to_host),
+    }
+
+    with contextlib.redirect_stdout(io.StringIO()): # silence per node output
+        start = time.perf_counter()
+        ars = ARSModel(nodes, cfg)
+        result['setup_seconds'] = time.perf_counter() - start
+
+        if cfg.solver.engine == SolverEngine.HEURISTIC:
+            result.update(solve_heuristic(ars))
+        else:
+            result.update(solve_cp_sat(ars))
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark building and solving ARSModel')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--vms', type=int, default=400)
+    parser.add_argument('--skew', type=float, default=0.5)
+    parser.add_argument('--rule-density', type=float, default=0.1)
+    parser.add_argument('--engine', nargs='+', default=[e.value for e in SolverEngine],
+                        choices=[e.value for e in SolverEngine])
+    parser.add_argument('--max-time', type=float, default=10)
+    args = parser.parse_args()
+
+    cfg = default_config()
+    cfg.solver.max_time_in_seconds = args.max_time
+
+    for engine in args.engine:
+        cfg.solver.engine = SolverEngine(engine)
+        print(json.dumps(measure(args.nodes, args.vms, cfg, args.skew, args.rule_density)))
+
+if __name__ == '__main__':
+    main()
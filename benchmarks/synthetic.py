@@ -0,0 +1,92 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import random
+
+from config import (AffinityRules, Vm2HostAffinityRule, Vm2HostAffinityType, Vm2VmAffinityRule,
+                    Vm2VmAffinityType)
+from model import Node, VirtualMachine
+
+GiB = 1024**3
+
+def generate_cluster(num_nodes, num_vms, seed=0, skew=0.0):
+    """Generate a cluster of identical nodes with randomly sized VMs.
+
+    With skew 0 VMs are spread round robin. A higher skew places them with
+    weights falling off by node position (node000 gets the most) and makes
+    cpu usage heavy tailed, a few VMs cause most of the load.
+    """
+
+    rnd = random.Random(seed)
+    # disks are drawn separately to keep the clusters of earlier versions
+    disk_rnd = random.Random(seed + 1)
+
+    nodes = [Node(
+        internal_id=node_id,
+        name='node{:03d}'.format(node_id),
+        memory_used=0,
+        memory_total=512 * GiB,
+        num_cpu=64,
+        virtual_machines=[],
+    ) for node_id in range(num_nodes)]
+
+    weights = [(node_id + 1) ** -skew for node_id in range(num_nodes)]
+
+    for vm_id in range(num_vms):
+        node = nodes[vm_id % num_nodes] if not skew else rnd.choices(nodes, weights)[0]
+        running = rnd.random() < 0.8
+        memory_max = rnd.choice([1, 2, 4, 8, 16]) * GiB
+        cpu_used = rnd.uniform(0, 2) if not skew else min(4, rnd.paretovariate(1 + 1 / skew) - 1)
+
+        node.virtual_machines.append(VirtualMachine(
+            internal_id=vm_id,
+            id=100 + vm_id,
+            name='vm{}'.format(vm_id),
+            state='running' if running else 'stopped',
+            locked=False,
+            node=node.name,
+            memory_used=int(memory_max * rnd.uniform(0.2, 1.0)) if running else 0,
+            memory_max=memory_max,
+            cpu_used=cpu_used if running else 0,
+            cpu_max=4,
+            disk_max=disk_rnd.choice([32, 64, 128, 512, 2048]) * GiB,
+        ))
+
+    # the VMs' memory is all a node uses
+    for node in nodes:
+        node.memory_used = sum(vm.memory_used for vm in node.virtual_machines)
+
+    return nodes
+
+def generate_rules(nodes, density, seed=0):
+    """Generate affinity rules covering about density of all VMs.
+
+    VM-to-VM rules group 2 to 4 VMs, alternating keep-apart and
+    keep-together, every fourth group is additionally bound to half of the
+    nodes by a run-here rule.
+    """
+
+    rnd = random.Random(seed)
+
+    vm_ids = [vm.id for node in nodes for vm in node.virtual_machines]
+    rnd.shuffle(vm_ids)
+    vm_ids = vm_ids[:int(len(vm_ids) * density)]
+
+    node_names = [node.name for node in nodes]
+
+    rules = AffinityRules()
+    while len(vm_ids) >= 2:
+        size = min(len(vm_ids), rnd.randint(2, 4))
+        group, vm_ids = set(vm_ids[:size]), vm_ids[size:]
+        n = len(rules.vm_to_vm)
+
+        type_ = Vm2VmAffinityType.KEEP_APART if n % 2 == 0 else Vm2VmAffinityType.KEEP_TOGETHER
+        rules.vm_to_vm.append(Vm2VmAffinityRule(name='group{}'.format(n), comment=None, type_=type_, virtual_machines=group))
+
+        if n % 4 == 1:
+            rules.vm_to_host.append(Vm2HostAffinityRule(
+                name='group{} hosts'.format(n), comment=None, nodes=set(rnd.sample(node_names, max(len(group), len(node_names) // 2))),
+                type_=Vm2HostAffinityType.RUN_HERE, virtual_machines=group,
+            ))
+
+    return rules
@@ -15,6 +15,32 @@ class Vm2HostAffinityType(enum.Enum):
     RUN_HERE = "run-here"
     RUN_ELSEWHERE = "run-elsewhere"
 
+class ConnectionBackend(enum.Enum):
+    PROXMOXER = "proxmoxer"
+    ASYNC = "async"
+
+class ModelFormulation(enum.Enum):
+    CLASSIC = "classic"
+    COMPACT = "compact"
+
+class ObjectiveMode(enum.Enum):
+    SQUARED = "squared"
+    L1 = "l1"
+    MINMAX = "minmax"
+    PIECEWISE = "piecewise"
+
+class SolverEngine(enum.Enum):
+    CP_SAT = "cp-sat"
+    HEURISTIC = "heuristic"
+
+class CollectionMode(enum.Enum):
+    PER_VM = "per-vm"
+    BULK = "bulk"
+
+class DemandMode(enum.Enum):
+    PERCENTILE = "percentile"
+    EWMA = "ewma"
+
 @serde
 @dataclass
 class General:
@@ -23,27 +49,180 @@ class General:
     password: str
     verify_ssl: Optional[bool] = True
 
+@serde
+@dataclass
+class Connection:
+    # proxmoxer: synchronous requests, async: aiohttp connection pool
+    backend: ConnectionBackend = ConnectionBackend.PROXMOXER
+    # per-vm: list VMs per node and fetch rrddata for every running VM
+    # bulk: build the state from /cluster/resources, rrddata only if needed
+    collection: CollectionMode = CollectionMode.PER_VM
+    # fetch the hourly MAX from rrddata in bulk mode instead of using the
+    # current usage reported by /cluster/resources
+    rrd_history: bool = False
+    # upper bound of concurrent rrddata requests (and pooled connections)
+    max_workers: int = 8
+    # async backend: concurrent requests in total and per node
+    max_concurrency: int = 32
+    max_concurrency_per_node: int = 8
+    # async backend: retries of failed requests, with exponential backoff
+    retries: int = 3
+    retry_backoff: float = 0.5
+
+@serde
+@dataclass
+class Weights:
+    # relative weights of the objective's terms, only their ratios matter
+    cpu: float = 1.0
+    memory: float = 1.0
+    migration: float = 1.0
+
 @serde
 @dataclass
 class Model:
     memory_precision: int = 1024**2
+    # compact: linear migration penalty without auxiliary variables
+    formulation: ModelFormulation = ModelFormulation.CLASSIC
+    # only consider the current and the n most underloaded nodes for each
+    # VM, 0 considers all nodes a VM may run on
+    max_candidate_nodes: int = 0
+    # how to measure the distance of the nodes to their target loads
+    objective: ObjectiveMode = ObjectiveMode.SQUARED
+    # number of tangents per side approximating the square in piecewise mode
+    piecewise_segments: int = 8
+    # order interchangeable VMs and empty nodes so the solver does not
+    # explore equivalent assignments
+    symmetry_breaking: bool = True
+    weights: Weights = field(default_factory=Weights)
 
 @serde
 @dataclass
 class Solver:
     max_time_in_seconds: int = 10
     num_search_workers: int = 1
+    # start the search from the current (or previously calculated) placement
+    hint: bool = True
+    # let the solver repair the hint if it violates constraints
+    repair_hint: bool = False
+    # solve parts of the cluster which do not share any constraint in
+    # parallel processes, 0 workers uses one process per cpu
+    partition: bool = False
+    partition_workers: int = 0
+    # solve with CP-SAT or only with the greedy/local search heuristic
+    engine: SolverEngine = SolverEngine.CP_SAT
+    heuristic_time_in_seconds: float = 1.0
+    # start CP-SAT from the heuristic's placement instead of the current one
+    heuristic_hint: bool = False
+    # use the heuristic's placement if CP-SAT finds no solution in time
+    fallback: bool = True
+    # minimize the imbalance first (stage1_time_share of the time), then the
+    # migration costs while staying within balance_tolerance of that
+    staged: bool = False
+    stage1_time_share: float = 0.5
+    balance_tolerance: float = 0.05
+    # only move VMs between the incremental_nodes nodes furthest from their
+    # targets, repeated with the next worst nodes until max_time_in_seconds
+    # is used up, each round may take incremental_time_in_seconds
+    incremental: bool = False
+    incremental_nodes: int = 4
+    incremental_time_in_seconds: int = 2
 
 @serde
 @dataclass
 class Migration:
     max_migrations_per_host: int = 3
+    # failed migrations are retried at most this many times
+    max_retries: int = 3
+    # seconds between two polls of the running migration tasks
+    poll_interval: float = 1.0
+    # bound the plan of a single cycle so that it completes within the
+    # interval, 0 means unlimited. memory is the memory used by the migrated
+    # VMs in bytes
+    max_migrations_per_cycle: int = 0
+    max_memory_per_cycle: int = 0
+    # VMs moved to and away from a single node per cycle
+    max_inbound_per_node: int = 0
+    max_outbound_per_node: int = 0
+    # order migrations so that no destination runs out of memory while the
+    # plan executes, VMs waiting on each other may take a detour over a
+    # staging node
+    memory_aware: bool = True
+    staging: bool = True
+    # learn migration durations from the memory and disk sizes of past
+    # migrations and use them as migration costs
+    cost_model: bool = False
+    cost_model_file: str = "ars-migrations.sqlite"
+    # migrations between two nodes before the pair gets its own fit
+    cost_model_min_samples: int = 10
+    # adapt the concurrency of every node to the throughput of its finished
+    # migrations (AIMD), starting at max_migrations_per_host and staying
+    # within min_ and max_adaptive_migrations_per_host
+    adaptive_concurrency: bool = False
+    min_migrations_per_host: int = 1
+    max_adaptive_migrations_per_host: int = 8
+    # bytes per second all running migrations may copy together, 0 means
+    # unlimited
+    bandwidth_budget: int = 0
+
+@serde
+@dataclass
+class Daemon:
+    # seconds between the start of two cycles in daemon mode, each cycle is
+    # delayed by up to jitter seconds
+    interval: int = 300
+    jitter: int = 30
+    # held while a cycle runs so that two instances never overlap
+    lock_file: str = "/tmp/ars.lock"
+
+@serde
+@dataclass
+class ChangeDetection:
+    # skip solving if the cluster did not change materially since the last run
+    enabled: bool = False
+    state_file: str = "ars.state"
+    # share of the cluster's cpu or memory usage that may change
+    tolerance: float = 0.05
+    # usage is compared in buckets, cpu in 1/100 cores, memory in bytes
+    cpu_bucket: int = 10
+    memory_bucket: int = 1073741824
+
+@serde
+@dataclass
+class History:
+    # keep the usage of VMs in a local database and place them by their
+    # demand over the stored samples instead of the latest one
+    enabled: bool = False
+    file: str = "ars-history.sqlite"
+    # seconds of samples kept and used for the demand
+    window: int = 86400
+    # fetch rrddata only for running VMs whose newest stored sample is older
+    # than this, all others just store the usage of the VM listing
+    backfill_after: int = 3600
+    demand: DemandMode = DemandMode.PERCENTILE
+    percentile: float = 95.0
+    # ewma: seconds after which the weight of a sample has halved
+    half_life: int = 3600
+
+@serde
+@dataclass
+class Metrics:
+    # print per node targets, every improving solution and solver statistics
+    verbose: bool = False
+    # append the timings and counters of every cycle as one JSON object
+    json_file: Optional[str] = None
+    # node exporter textfile collector file, rewritten after every cycle
+    prometheus_file: Optional[str] = None
 
 
 @serde
 @dataclass
 class Maintenance:
-    nodes: Optional[Set[int]] = field(default_factory=set)
+    nodes: Optional[Set[str]] = field(default_factory=set)
+    # main.py --evacuate: seconds CP-SAT may spend improving the heuristic's
+    # placement of the evacuated VMs, 0 only uses the heuristic
+    evacuate_time_in_seconds: int = 5
+    # concurrent migrations per node while evacuating
+    evacuate_migrations_per_host: int = 8
 
 
 @serde
@@ -78,8 +257,13 @@ class Config:
     model: Model
     solver: Solver
     migration: Migration
-    maintenance: Maintenance = field(rename="maintenance", default=Maintenance())
-    affinity_rules: AffinityRules = field(rename="affinity-rules", default=AffinityRules())
+    connection: Connection = field(default_factory=Connection)
+    daemon: Daemon = field(default_factory=Daemon)
+    change_detection: ChangeDetection = field(rename="change-detection", default_factory=ChangeDetection)
+    metrics: Metrics = field(default_factory=Metrics)
+    history: History = field(default_factory=History)
+    maintenance: Maintenance = field(rename="maintenance", default_factory=Maintenance)
+    affinity_rules: AffinityRules = field(rename="affinity-rules", default_factory=AffinityRules)
 
     @staticmethod
     def from_file(file_):
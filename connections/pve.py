@@ -4,121 +4,102 @@
 import math
 from proxmoxer.core import ResourceException as ProxmoxerResourceException
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from config import CollectionMode
+from connections.scheduler import AdaptiveConcurrency, MigrationScheduler, plan_migrations
 from model import VirtualMachine, Node
 
-def wait_for_tasks(proxmox, migration_nodes, running):
-    while True:
-        for task in proxmox.cluster.tasks.get():
-            if "endtime" in task and task["upid"] in running:
-                print(sorted(task.items()))
-                if task["status"] != "OK": # retry failed migrations
-                    vm, dst_node = running[task["upid"]]
-                    del running[task["upid"]]
+def _start_migration(proxmox, vm, dst_node):
+    return proxmox.nodes(vm.node).qemu(vm.id).migrate.post(**{
+        "target": dst_node,
+        "online": 1,
+        "with-local-disks": 1,
+    })
 
-                    new_task = proxmox.nodes(vm.node).qemu(vm.id).migrate.post(**{
-                        "target": dst_node,
-                        "online": 1,
-                        "with-local-disks": 1,
-                    })
+def realize_migrations(logger, proxmox, migrations, cfg, metrics=None, nodes=None, allowed=None):
+    """Run the migrations, nodes is the state they start from and allowed the nodes each VM may run on."""
 
-                    running[new_task] = (vm, dst_node)
-                else: # otherwise mark as done
-                    try:
-                        vm, dst_node = running[task["upid"]]
+    if nodes is not None and cfg.migration.memory_aware:
+        migrations = plan_migrations(nodes, migrations, cfg, allowed)
+    else:
+        nodes = None
 
-                        # task has stopped, remove from migration node load monitoring
-                        migration_nodes[vm.node] -= 1
-                        migration_nodes[dst_node] -= 1
+    concurrency = AdaptiveConcurrency.from_config(cfg)
+    scheduler = MigrationScheduler(migrations, cfg.migration.max_migrations_per_host, cfg.migration.max_retries, nodes,
+                                   concurrency, cfg.migration.bandwidth_budget)
 
-                        del running[task["upid"]]
-                    except KeyError:
-                        pass
-
-                    return # exit after a task terminates to schedule a new one
+    while not scheduler.done:
+        # start everything the per node limits allow
+        for vm, dst_node in scheduler.ready():
+            logger.info(
+                "Migrating VM {}='{}' from {} to {}.".format(vm.id, vm.name, vm.node, dst_node)
+            )
 
-        time.sleep(1)
+            try:
+                task = _start_migration(proxmox, vm, dst_node)
+            except ProxmoxerResourceException as e:
+                print('migration of VM {} failed to start {!r}'.format(vm.id, e))
+                scheduler.start_failed(vm, dst_node)
+                continue
 
+            scheduler.started(task, vm, dst_node)
 
-def realize_migrations(logger, proxmox, migrations, cfg):
-    # TODO: handle failed migrations
+        time.sleep(cfg.migration.poll_interval)
 
-    MAX_MIGRATIONS_PER_HOST = cfg.migration.max_migrations_per_host
+        # only poll the tasks started here
+        for task, (vm, dst_node) in list(scheduler.running.items()):
+            status = proxmox.nodes(vm.node).tasks(task).status.get()
+            if status['status'] != 'stopped':
+                continue
 
-    running = {}
-    src_nodes = {vm.node for vm, _ in migrations}
-    dst_nodes = {dst_node for _, dst_node in migrations}
-    migration_nodes = { node: 0 for node in src_nodes | dst_nodes }
+            if cfg.metrics.verbose:
+                print(sorted(status.items()))
+            scheduler.finished(task, status.get('exitstatus') == 'OK')
 
-    while migrations:
-        for i, (vm, dst_node) in enumerate(migrations):
+    if concurrency.adaptive and concurrency.limits:
+        print('migrations per node:', {node: concurrency.limit(node) for node in sorted(concurrency.limits)})
 
-            src_node = vm.node
-            if migration_nodes[src_node] >= MAX_MIGRATIONS_PER_HOST:
-                logger.debug(
-                    "Postponing migration of VM {} , because src node {} is busy".format(vm.id, src_node)
-                )
-                continue
-            if migration_nodes[dst_node] >= MAX_MIGRATIONS_PER_HOST:
-                logger.debug(
-                    "Postponing migration of VM {} , because dst node {} is busy".format(vm.id, dst_node)
-                )
-                continue
+    if metrics is not None:
+        for vm, dst_node, seconds, ok in scheduler.completed:
+            metrics.migration(vm, dst_node, seconds, ok)
 
-            logger.info(
-                "Migrating VM {}='{}' from {} to {}.".format(vm.id, vm.name, vm.node, dst_node)
-            )
+    for vm, dst_node in scheduler.failed:
+        logger.warning(
+            "Giving up migration of VM {}='{}' from {} to {}.".format(vm.id, vm.name, vm.node, dst_node)
+        )
 
-            task = proxmox.nodes(vm.node).qemu(vm.id).migrate.post(**{
-                "target": dst_node,
-                "online": 1,
-                "with-local-disks": 1,
-            })
+    return scheduler.failed
 
-            # increase node task count for migration on source and destination node
-            migration_nodes[vm.node] += 1
-            migration_nodes[dst_node] += 1
+def latest_usage(rrddata):
+    # newest sample holding both cpu and memory usage
+    for data in sorted(rrddata, key=lambda x: x['time'], reverse=True):
+        if 'cpu' in data and 'mem' in data:
+            return data['cpu'], math.ceil(data['mem'])
 
-            running[task] = (vm, dst_node)
-            del migrations[i]
-            break
-        else:
-            time.sleep(1)
-            wait_for_tasks(proxmox, migration_nodes, running)
+    return 0, 0
 
+def build_state(raw_nodes, usage):
+    """Build the Node/VirtualMachine list.
 
-    while len(running) > 0:
-        wait_for_tasks(proxmox, migration_nodes, running)
+    raw_nodes is a list of (internal_node_id, node, raw_vms) with the node and
+    VM dicts as returned by the API, usage maps (node, vmid) of running VMs to
+    their (cpu, mem) usage.
+    """
 
-def fetch_current_state(pve):
     nodes = []
 
     internal_vmid = 0
 
-    for internal_node_id, node in enumerate(sorted(pve.nodes.get(), key=lambda n: n['node'])):
+    for internal_node_id, node, raw_vms in raw_nodes:
         virtual_machines = []
 
-        try:
-            raw_vms = sorted(pve.nodes(node['node']).qemu.get(full=1), key=lambda v: v['vmid'])
-        except ProxmoxerResourceException as e:
-            print('node unavailable {!r}'.format(e))
-            continue
-
-
         for vm in raw_vms:
             if vm['status'] != 'running':
                 cpu = 0
                 mem = 0
             else:
-                rrddata = sorted(pve.nodes(node['node']).qemu(vm['vmid']).rrddata.get(timeframe='hour', cf='MAX'), key=lambda x: x['time'], reverse=True)
-
-                cpu, mem = 0, 0
-
-                for data in rrddata:
-                    if 'cpu' in data and 'mem' in data:
-                        cpu = data['cpu']
-                        mem = math.ceil(data['mem'])
-                        break
+                cpu, mem = usage[node['node'], vm['vmid']]
 
             virtual_machines.append(VirtualMachine(
                 internal_id = internal_vmid,
@@ -131,9 +112,11 @@ def fetch_current_state(pve):
 
                 memory_used=mem,
                 memory_max=vm['maxmem'],
+                disk_max=vm.get('maxdisk', 0),
 
+                # qemu listings call it cpus, /cluster/resources maxcpu
                 cpu_used=cpu,
-                cpu_max=vm['cpus'],
+                cpu_max=vm['cpus'] if 'cpus' in vm else vm['maxcpu'],
             ))
 
             internal_vmid += 1
@@ -149,3 +132,140 @@ def fetch_current_state(pve):
 
     return nodes
 
+def split_resources(resources):
+    """Split /cluster/resources into sorted (internal_node_id, node, raw_vms) of online nodes."""
+
+    raw_nodes = sorted((r for r in resources if r['type'] == 'node'), key=lambda n: n['node'])
+    raw_vms = sorted((r for r in resources if r['type'] == 'qemu'), key=lambda v: v['vmid'])
+
+    node_vms = {node['node']: [] for node in raw_nodes}
+    for vm in raw_vms:
+        if vm['node'] in node_vms:
+            node_vms[vm['node']].append(vm)
+
+    result = []
+    for internal_node_id, node in enumerate(raw_nodes):
+        if node.get('status') != 'online':
+            print('node unavailable {!r}'.format(node['node']))
+            continue
+
+        result.append((internal_node_id, node, node_vms[node['node']]))
+
+    return result
+
+def needs_rrd(vm, cfg):
+    # /cluster/resources already reports the current usage of running VMs,
+    # with a usage history rrddata is only fetched to backfill it
+    if vm['status'] != 'running':
+        return False
+    if 'cpu' not in vm or 'mem' not in vm:
+        return True
+    return cfg.connection.rrd_history and not cfg.history.enabled
+
+def listing_usage(vm):
+    return vm.get('cpu', 0), math.ceil(vm.get('mem', 0))
+
+def _rrddata(pve, node, vmid):
+    return pve.nodes(node).qemu(vmid).rrddata.get(timeframe='hour', cf='MAX')
+
+def _rrd_usage(pve, node, vmid):
+    return latest_usage(_rrddata(pve, node, vmid))
+
+def _session(pve):
+    # the requests session proxmoxer shares between all calls, if any
+    session = vars(pve).get('_store', {}).get('session')
+    return session if hasattr(session, 'mount') else None
+
+def _pool_session(pve, size):
+    # make the connection pool large enough to keep a connection per worker alive
+    session = _session(pve)
+    if session is None:
+        return
+
+    from requests.adapters import HTTPAdapter
+    session.mount('https://', HTTPAdapter(pool_connections=size, pool_maxsize=size))
+
+def fetch_rrddata(pve, targets, max_workers=8):
+    """Fetch the last hour of rrddata for (node, vmid) pairs with a bounded pool of workers."""
+
+    def fetch(target):
+        try:
+            return _rrddata(pve, *target)
+        except ProxmoxerResourceException as e:
+            print('rrddata unavailable for VM {} {!r}'.format(target[1], e))
+            return None
+
+    if not targets:
+        return {}
+
+    max_workers = max(1, min(max_workers, len(targets)))
+    _pool_session(pve, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(targets, executor.map(fetch, targets)))
+
+def fetch_rrd_usage(pve, targets, max_workers=8):
+    """Fetch the latest rrddata usage for (node, vmid) pairs."""
+
+    rrddata = fetch_rrddata(pve, targets, max_workers)
+    return {target: latest_usage(data) if data is not None else None for target, data in rrddata.items()}
+
+def fetch_current_state(pve, cfg=None):
+    if cfg is not None and cfg.connection.collection == CollectionMode.BULK:
+        return fetch_current_state_bulk(pve, cfg)
+
+    raw_nodes = []
+    usage = {}
+
+    for internal_node_id, node in enumerate(sorted(pve.nodes.get(), key=lambda n: n['node'])):
+        try:
+            raw_vms = sorted(pve.nodes(node['node']).qemu.get(full=1), key=lambda v: v['vmid'])
+        except ProxmoxerResourceException as e:
+            print('node unavailable {!r}'.format(e))
+            continue
+
+        for vm in raw_vms:
+            if vm['status'] != 'running':
+                continue
+
+            # a usage history stores the listing's usage instead
+            if cfg is not None and cfg.history.enabled and not needs_rrd(vm, cfg):
+                usage[node['node'], vm['vmid']] = listing_usage(vm)
+            else:
+                usage[node['node'], vm['vmid']] = _rrd_usage(pve, node['node'], vm['vmid'])
+
+        raw_nodes.append((internal_node_id, node, raw_vms))
+
+    return build_state(raw_nodes, usage)
+
+def fetch_current_state_bulk(pve, cfg):
+    """Build the state from the cluster wide resource list.
+
+    One request returns all nodes and VMs including their current usage.
+    rrddata is only requested for running VMs if rrd_history is enabled or the
+    resource list lacks usage data for a VM.
+    """
+
+    raw_nodes = split_resources(pve.cluster.resources.get())
+
+    # collect rrddata only where it is actually needed
+    rrd_targets = [(node['node'], vm['vmid']) for _, node, raw_vms in raw_nodes for vm in raw_vms if needs_rrd(vm, cfg)]
+    rrd_usage = fetch_rrd_usage(pve, rrd_targets, cfg.connection.max_workers)
+
+    usage = {}
+    for _, node, raw_vms in raw_nodes:
+        for vm in raw_vms:
+            if vm['status'] != 'running':
+                continue
+
+            if rrd_usage.get((node['node'], vm['vmid'])) is not None:
+                usage[node['node'], vm['vmid']] = rrd_usage[node['node'], vm['vmid']]
+            else:
+                usage[node['node'], vm['vmid']] = listing_usage(vm)
+
+    return build_state(raw_nodes, usage)
+
+def close(pve):
+    session = _session(pve)
+    if session is not None:
+        session.close()
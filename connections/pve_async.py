@@ -0,0 +1,415 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import random
+import time
+
+import aiohttp
+from proxmoxer.core import ResourceException as ProxmoxerResourceException
+
+from config import CollectionMode
+from connections.pve import build_state, latest_usage, listing_usage, needs_rrd, split_resources
+from connections.scheduler import AdaptiveConcurrency, NodeMemory, plan_migrations
+
+# transient failures worth another attempt
+RETRY_STATUS = {429, 500, 502, 503, 504, 596}
+
+class AsyncProxmoxAPI:
+    """Proxmox VE API client on a shared keep-alive connection pool.
+
+    All requests are bounded by a global and a per-node concurrency limit and
+    retried with exponential backoff on connection errors and transient HTTP
+    errors. The client owns its event loop, so the synchronous
+    fetch_current_state and realize_migrations below can be used in place of
+    the ones in connections.pve.
+    """
+
+    def __init__(self, host, user, password, verify_ssl=True, max_concurrency=32,
+                 max_concurrency_per_node=8, retries=3, retry_backoff=0.5):
+        if ':' not in host:
+            host = '{}:8006'.format(host)
+
+        self.base_url = 'https://{}/api2/json'.format(host)
+        self.user = user
+        self.password = password
+        self.verify_ssl = verify_ssl
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_node = max_concurrency_per_node
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self.loop = asyncio.new_event_loop()
+
+        self._session = None
+        self._ticket = None
+        self._csrf_token = None
+        self._global_limit = None
+        self._node_limits = {}
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            host=cfg.general.host, user=cfg.general.user, password=cfg.general.password,
+            verify_ssl=cfg.general.verify_ssl,
+            max_concurrency=cfg.connection.max_concurrency,
+            max_concurrency_per_node=cfg.connection.max_concurrency_per_node,
+            retries=cfg.connection.retries,
+            retry_backoff=cfg.connection.retry_backoff,
+        )
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        if self._session is not None:
+            self.run(self._session.close())
+            self._session = None
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                ssl=None if self.verify_ssl else False,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+            self._global_limit = asyncio.Semaphore(self.max_concurrency)
+
+        return self._session
+
+    async def _login(self):
+        session = await self._get_session()
+        async with session.post(self.base_url + '/access/ticket',
+                                data={'username': self.user, 'password': self.password}) as response:
+            if response.status != 200:
+                raise ProxmoxerResourceException(response.status, response.reason, 'login failed')
+
+            data = (await response.json())['data']
+
+        self._ticket = data['ticket']
+        self._csrf_token = data['CSRFPreventionToken']
+
+    def _node_limit(self, node):
+        if node not in self._node_limits:
+            self._node_limits[node] = asyncio.Semaphore(self.max_concurrency_per_node)
+        return self._node_limits[node]
+
+    async def request(self, method, path, **params):
+        """Issue an API request and return its data, path is relative to /api2/json."""
+
+        session = await self._get_session()
+        if self._ticket is None:
+            await self._login()
+
+        # requests against /nodes/<node>/... are limited per node
+        segments = path.strip('/').split('/')
+        node = segments[1] if segments[0] == 'nodes' and len(segments) > 1 else None
+
+        # only retry requests that are safe to repeat, a POST is only
+        # repeated if it never reached the server
+        idempotent = method == 'GET'
+        retryable_errors = (aiohttp.ClientError, asyncio.TimeoutError) if idempotent else aiohttp.ClientConnectorError
+
+        for attempt in range(self.retries + 1):
+            headers = {'Cookie': 'PVEAuthCookie={}'.format(self._ticket)}
+            if not idempotent:
+                headers['CSRFPreventionToken'] = self._csrf_token
+
+            kwargs = {'params': params} if idempotent else {'data': params}
+
+            try:
+                async with self._global_limit, self._node_limit(node):
+                    async with session.request(method, self.base_url + path, headers=headers, **kwargs) as response:
+                        if response.status == 401 and attempt < self.retries: # ticket expired
+                            await self._login()
+                            continue
+
+                        if response.status < 400:
+                            return (await response.json())['data']
+
+                        error = ProxmoxerResourceException(response.status, response.reason, await response.text())
+                        if not idempotent or response.status not in RETRY_STATUS or attempt >= self.retries:
+                            raise error
+            except retryable_errors as e:
+                if attempt >= self.retries:
+                    raise
+                error = e
+
+            delay = self.retry_backoff * 2**attempt
+            print('retrying {} {} in {:.1f}s {!r}'.format(method, path, delay, error))
+            await asyncio.sleep(delay * (1 + random.random() / 2))
+
+    async def get(self, path, **params):
+        return await self.request('GET', path, **params)
+
+    async def post(self, path, **params):
+        return await self.request('POST', path, **params)
+
+async def _rrddata(pve, node, vmid):
+    try:
+        return await pve.get('/nodes/{}/qemu/{}/rrddata'.format(node, vmid), timeframe='hour', cf='MAX')
+    except ProxmoxerResourceException as e:
+        print('rrddata unavailable for VM {} {!r}'.format(vmid, e))
+        return None
+
+async def _rrd_usage(pve, node, vmid):
+    rrddata = await _rrddata(pve, node, vmid)
+    return latest_usage(rrddata) if rrddata is not None else None
+
+def fetch_rrddata(pve, targets, max_workers=None):
+    """Fetch the last hour of rrddata for (node, vmid) pairs, bounded by the client's concurrency limits and max_workers."""
+
+    async def fetch():
+        if not max_workers:
+            return await asyncio.gather(*(_rrddata(pve, node, vmid) for node, vmid in targets))
+
+        workers = asyncio.Semaphore(max_workers)
+
+        async def limited(node, vmid):
+            async with workers:
+                return await _rrddata(pve, node, vmid)
+
+        return await asyncio.gather(*(limited(node, vmid) for node, vmid in targets))
+
+    return dict(zip(targets, pve.run(fetch())))
+
+async def _fetch_node_vms(pve, internal_node_id, node):
+    try:
+        raw_vms = await pve.get('/nodes/{}/qemu'.format(node['node']), full=1)
+    except ProxmoxerResourceException as e:
+        print('node unavailable {!r}'.format(e))
+        return None
+
+    return (internal_node_id, node, sorted(raw_vms, key=lambda v: v['vmid']))
+
+async def _fetch_current_state(pve, cfg):
+    if cfg is not None and cfg.connection.collection == CollectionMode.BULK:
+        raw_nodes = split_resources(await pve.get('/cluster/resources'))
+        targets = [(node['node'], vm) for _, node, raw_vms in raw_nodes for vm in raw_vms if needs_rrd(vm, cfg)]
+    else:
+        nodes = sorted(await pve.get('/nodes'), key=lambda n: n['node'])
+        raw_nodes = await asyncio.gather(*(
+            _fetch_node_vms(pve, internal_node_id, node) for internal_node_id, node in enumerate(nodes)
+        ))
+        raw_nodes = [raw_node for raw_node in raw_nodes if raw_node is not None]
+        # a usage history stores the listing's usage instead
+        history = cfg is not None and cfg.history.enabled
+        targets = [(node['node'], vm) for _, node, raw_vms in raw_nodes for vm in raw_vms
+                   if vm['status'] == 'running' and (not history or needs_rrd(vm, cfg))]
+
+    rrd_usage = await asyncio.gather(*(_rrd_usage(pve, node, vm['vmid']) for node, vm in targets))
+
+    usage = {}
+    for _, node, raw_vms in raw_nodes:
+        for vm in raw_vms:
+            if vm['status'] == 'running':
+                usage[node['node'], vm['vmid']] = listing_usage(vm)
+
+    for (node, vm), vm_usage in zip(targets, rrd_usage):
+        if vm_usage is not None:
+            usage[node, vm['vmid']] = vm_usage
+
+    return build_state(raw_nodes, usage)
+
+def fetch_current_state(pve, cfg=None):
+    return pve.run(_fetch_current_state(pve, cfg))
+
+class MemoryGate:
+    """Let a migration start once its destination has room for the VM.
+
+    If every remaining VM waits for memory and no migration is running
+    that could free some, one of them starts anyway so the plan cannot
+    stall.
+    """
+
+    def __init__(self, nodes, num_vms):
+        self.memory = NodeMemory(nodes)
+        self.changed = asyncio.Condition()
+        self.waiting = 0
+        self.remaining = num_vms
+
+    def _may_start(self, vm, dst_node):
+        return self.memory.fits(vm, dst_node) or (not self.memory.in_flight and self.waiting == self.remaining)
+
+    async def acquire(self, vm, dst_node):
+        async with self.changed:
+            self.waiting += 1
+            await self.changed.wait_for(lambda: self._may_start(vm, dst_node))
+            self.waiting -= 1
+            self.memory.reserve(vm, dst_node)
+
+    async def release(self, vm, dst_node, ok):
+        async with self.changed:
+            self.memory.release(vm, dst_node, ok)
+            self.changed.notify_all()
+
+    async def done(self):
+        async with self.changed:
+            self.remaining -= 1
+            self.changed.notify_all()
+
+class SlotGate:
+    """Per node migration slots, limited by AdaptiveConcurrency and the bandwidth budget.
+
+    Both nodes of a migration are taken at once, so migrations running in
+    opposite directions cannot deadlock. One migration always runs,
+    whatever the budget.
+    """
+
+    def __init__(self, concurrency, bandwidth_budget=0):
+        self.concurrency = concurrency
+        self.bandwidth_budget = bandwidth_budget
+        self.bandwidth = 0
+        self.busy = {}
+        self.changed = asyncio.Condition()
+
+    def _free(self, vm, dst_node):
+        if any(self.busy.get(node, 0) >= self.concurrency.limit(node) for node in (vm.node, dst_node)):
+            return False
+        return (not self.bandwidth_budget or not any(self.busy.values())
+                or self.bandwidth + self.concurrency.expected_rate(vm, dst_node) <= self.bandwidth_budget)
+
+    async def acquire(self, vm, dst_node):
+        """Take the slots of both nodes, returns the expected rate to pass to release."""
+
+        async with self.changed:
+            await self.changed.wait_for(lambda: self._free(vm, dst_node))
+            for node in (vm.node, dst_node):
+                self.busy[node] = self.busy.get(node, 0) + 1
+            rate = self.concurrency.expected_rate(vm, dst_node)
+            self.bandwidth += rate
+            return rate
+
+    async def finished(self, vm, dst_node, seconds, ok):
+        async with self.changed:
+            self.concurrency.finished(vm, dst_node, seconds, ok)
+            self.changed.notify_all()
+
+    async def release(self, vm, dst_node, rate):
+        async with self.changed:
+            for node in (vm.node, dst_node):
+                self.busy[node] -= 1
+            # start over from zero once idle, the sum drifts with the float rounding
+            self.bandwidth = self.bandwidth - rate if any(self.busy.values()) else 0
+            self.changed.notify_all()
+
+async def _migrate(logger, pve, vm, dst_node, slots, cfg, metrics, gate):
+    if gate is not None:
+        await gate.acquire(vm, dst_node)
+
+    failed = (vm, dst_node)
+    try:
+        failed = await _migrate_task(logger, pve, vm, dst_node, slots, cfg, metrics)
+        return failed
+    finally:
+        if gate is not None:
+            await gate.release(vm, dst_node, ok=failed is None)
+
+async def _migrate_hops(logger, pve, hops, slots, cfg, metrics, gate):
+    # hops of one VM run one after the other, a failed one ends the chain
+    try:
+        for vm, dst_node in hops:
+            failed = await _migrate(logger, pve, vm, dst_node, slots, cfg, metrics, gate)
+            if failed is not None:
+                return failed
+        return None
+    finally:
+        if gate is not None:
+            await gate.done()
+
+async def _migrate_task(logger, pve, vm, dst_node, slots, cfg, metrics):
+    rate = await slots.acquire(vm, dst_node)
+    try:
+        for _ in range(cfg.migration.max_retries + 1):
+            logger.info(
+                "Migrating VM {}='{}' from {} to {}.".format(vm.id, vm.name, vm.node, dst_node)
+            )
+
+            try:
+                upid = await pve.post('/nodes/{}/qemu/{}/migrate'.format(vm.node, vm.id), **{
+                    "target": dst_node,
+                    "online": 1,
+                    "with-local-disks": 1,
+                })
+            except (ProxmoxerResourceException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('migration of VM {} failed to start {!r}'.format(vm.id, e))
+                continue
+
+            started = time.monotonic()
+
+            # poll only the task that was started here
+            try:
+                while True:
+                    await asyncio.sleep(cfg.migration.poll_interval)
+                    status = await pve.get('/nodes/{}/tasks/{}/status'.format(vm.node, upid))
+                    if status['status'] == 'stopped':
+                        break
+            except (ProxmoxerResourceException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # the task may still run, starting it again would only clash with it
+                print('lost track of the migration of VM {} {!r}'.format(vm.id, e))
+                break
+
+            if cfg.metrics.verbose:
+                print(sorted(status.items()))
+
+            ok = status.get('exitstatus') == 'OK'
+            seconds = time.monotonic() - started
+            await slots.finished(vm, dst_node, seconds, ok)
+            if metrics is not None:
+                metrics.migration(vm, dst_node, seconds, ok)
+            if ok:
+                return None
+    finally:
+        await slots.release(vm, dst_node, rate)
+
+    logger.warning(
+        "Giving up migration of VM {}='{}' from {} to {}.".format(vm.id, vm.name, vm.node, dst_node)
+    )
+    return (vm, dst_node)
+
+async def _realize_migrations(logger, pve, migrations, cfg, metrics, nodes, allowed):
+    memory_aware = nodes is not None and cfg.migration.memory_aware
+    if memory_aware:
+        migrations = plan_migrations(nodes, migrations, cfg, allowed)
+
+    hops = {}
+    for vm, dst_node in migrations:
+        hops.setdefault(vm.id, []).append((vm, dst_node))
+
+    gate = MemoryGate(nodes, len(hops)) if memory_aware else None
+
+    concurrency = AdaptiveConcurrency.from_config(cfg)
+    slots = SlotGate(concurrency, cfg.migration.bandwidth_budget)
+
+    results = await asyncio.gather(*(_migrate_hops(logger, pve, vm_hops, slots, cfg, metrics, gate) for vm_hops in hops.values()),
+                                   return_exceptions=True)
+
+    # anything unexpected only fails the migrations of its VM
+    failed = []
+    for vm_hops, result in zip(hops.values(), results):
+        if isinstance(result, Exception):
+            vm, dst_node = vm_hops[0]
+            logger.warning(
+                "Migration of VM {}='{}' from {} to {} failed: {!r}.".format(vm.id, vm.name, vm.node, dst_node, result)
+            )
+            result = vm_hops[0]
+        failed.append(result)
+
+    if concurrency.adaptive and concurrency.limits:
+        print('migrations per node:', {node: concurrency.limit(node) for node in sorted(concurrency.limits)})
+
+    return [migration for migration in failed if migration is not None]
+
+def realize_migrations(logger, proxmox, migrations, cfg, metrics=None, nodes=None, allowed=None):
+    return proxmox.run(_realize_migrations(logger, proxmox, migrations, cfg, metrics, nodes, allowed))
+
+def close(pve):
+    pve.close()
@@ -0,0 +1,273 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import json
+import random
+import threading
+import time
+
+from proxmoxer.core import ResourceException as ProxmoxerResourceException
+
+class _Resource:
+    """Build request paths like proxmoxer, e.g. api.nodes('pve01').qemu.get(full=1)."""
+
+    def __init__(self, api, path):
+        self._api = api
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Resource(self._api, '{}/{}'.format(self._path, name))
+
+    def __call__(self, *segments):
+        return _Resource(self._api, '/'.join([self._path, *(str(segment) for segment in segments)]))
+
+    def get(self, *segments, **params):
+        return self._api._request('GET', self(*segments)._path, params)
+
+    def post(self, *segments, **params):
+        return self._api._request('POST', self(*segments)._path, params)
+
+def _key(method, path, params):
+    return method, path, json.dumps(params, sort_keys=True)
+
+class Recorder:
+    """Forward requests to a ProxmoxAPI and append them with their responses to a JSON lines file."""
+
+    def __init__(self, pve, path):
+        self._pve = pve
+        self._file = open(path, 'a')
+        self._lock = threading.Lock() # rrddata is fetched from several threads
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Resource(self, '/' + name)
+
+    def __call__(self, *segments):
+        return _Resource(self, '')(*segments)
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def _request(self, method, path, params):
+        record = {'method': method, 'path': path, 'params': params}
+        resource = self._pve(path.lstrip('/'))
+
+        try:
+            record['response'] = getattr(resource, method.lower())(**params)
+        except ProxmoxerResourceException as e:
+            record['error'] = [e.status_code, e.status_message, e.content]
+            self._write(record)
+            raise
+
+        self._write(record)
+        return record['response']
+
+    def close(self):
+        self._file.close()
+
+class FakeProxmoxAPI:
+    """Local stand-in for ProxmoxAPI.
+
+    GET requests are answered from a recording, repeated requests get the
+    recorded responses in order and then the last one again. Migrations are
+    simulated: a migrate POST starts a task which takes a random duration
+    and fails with probability failure_rate. Successful migrations move the
+    VM in the replayed VM listings. Simulated time runs speedup times faster
+    than wall clock time.
+    """
+
+    def __init__(self, records, duration=(5.0, 30.0), failure_rate=0.0, speedup=1.0, seed=0):
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.speedup = speedup
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._responses = {}
+        self._served = {}
+        for record in records:
+            key = _key(record['method'], record['path'], record.get('params', {}))
+            self._responses.setdefault(key, []).append(record)
+
+        # VM listings and locations as first recorded, updated by migrations
+        self._vms = {}
+        for (method, path, _), responses in self._responses.items():
+            segments = path.strip('/').split('/')
+            if method == 'GET' and len(segments) == 3 and segments[0] == 'nodes' and segments[2] == 'qemu':
+                for vm in responses[0].get('response') or []:
+                    self._vms.setdefault(vm['vmid'], dict(vm, node=segments[1]))
+            elif method == 'GET' and path == '/cluster/resources':
+                for vm in responses[0].get('response') or []:
+                    if vm['type'] == 'qemu':
+                        self._vms.setdefault(vm['vmid'], dict(vm))
+
+        self._recorded_node = {vmid: vm['node'] for vmid, vm in self._vms.items()}
+
+        self._tasks = {}
+        self.migrations = [] # (vmid, source, target, duration, ok) of finished tasks
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, 'r') as f:
+            return cls([json.loads(line) for line in f if line.strip()], **kwargs)
+
+    @classmethod
+    def from_cluster(cls, nodes, **kwargs):
+        """Simulate the API of a cluster given as list of Node."""
+
+        records = []
+
+        def add(path, response, **params):
+            records.append({'method': 'GET', 'path': path, 'params': params, 'response': response})
+
+        raw_nodes = []
+        resources = []
+        for node in nodes:
+            raw_node = {
+                'node': node.name, 'status': 'online', 'mem': node.memory_used,
+                'maxmem': node.memory_total, 'maxcpu': node.num_cpu,
+            }
+            raw_nodes.append(raw_node)
+            resources.append(dict(raw_node, type='node'))
+
+            raw_vms = []
+            for vm in node.virtual_machines:
+                raw_vm = {
+                    'vmid': vm.id, 'name': vm.name, 'status': vm.state, 'maxmem': vm.memory_max,
+                    'cpus': vm.cpu_max, 'cpu': vm.cpu_used, 'mem': vm.memory_used, 'maxdisk': vm.disk_max,
+                }
+                if vm.locked:
+                    raw_vm['lock'] = 'backup'
+                raw_vms.append(raw_vm)
+                resources.append(dict(raw_vm, type='qemu', node=node.name, maxcpu=vm.cpu_max))
+
+                if vm.state == 'running':
+                    add('/nodes/{}/qemu/{}/rrddata'.format(node.name, vm.id),
+                        [{'time': 0, 'cpu': vm.cpu_used, 'mem': vm.memory_used}], timeframe='hour', cf='MAX')
+
+            add('/nodes/{}/qemu'.format(node.name), raw_vms, full=1)
+
+        add('/nodes', raw_nodes)
+        add('/cluster/resources', resources)
+
+        return cls(records, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Resource(self, '/' + name)
+
+    def __call__(self, *segments):
+        return _Resource(self, '')(*segments)
+
+    def _now(self):
+        return time.monotonic() * self.speedup
+
+    def _replay(self, method, path, params):
+        key = _key(method, path, params)
+
+        # VMs moved by simulated migrations keep their recorded node paths
+        segments = path.strip('/').split('/')
+        if key not in self._responses and len(segments) > 3 and segments[0] == 'nodes' and segments[2] == 'qemu':
+            recorded_node = self._recorded_node.get(int(segments[3]))
+            if recorded_node is not None:
+                segments[1] = recorded_node
+                key = _key(method, '/' + '/'.join(segments), params)
+
+        if key not in self._responses:
+            raise ProxmoxerResourceException(404, 'Not Found', 'nothing recorded for {} {}'.format(method, path))
+
+        responses = self._responses[key]
+        served = self._served.get(key, 0)
+        self._served[key] = served + 1
+        record = responses[min(served, len(responses) - 1)]
+
+        if 'error' in record:
+            raise ProxmoxerResourceException(*record['error'])
+        return record['response']
+
+    def _task_status(self, upid):
+        task = self._tasks[upid]
+        status = {
+            'upid': upid, 'node': task['node'], 'type': 'qmigrate', 'id': str(task['vmid']),
+            'starttime': task['started'], 'status': 'running',
+        }
+
+        if self._now() - task['started'] < task['duration']:
+            return status
+
+        if not task['finished']:
+            task['finished'] = True
+            if task['ok']:
+                self._vms[task['vmid']]['node'] = task['target']
+            self.migrations.append((task['vmid'], task['node'], task['target'], task['duration'], task['ok']))
+
+        status.update(status='stopped', endtime=task['started'] + task['duration'],
+                      exitstatus='OK' if task['ok'] else 'migration problems')
+        return status
+
+    def _migrate(self, node, vmid, params):
+        vm = self._vms.get(vmid)
+        if vm is None or vm['node'] != node:
+            raise ProxmoxerResourceException(500, 'Internal Server Error', 'VM {} not on node {}'.format(vmid, node))
+
+        upid = 'UPID:{}:{:08X}:qmigrate:{}:root@pam:'.format(node, len(self._tasks), vmid)
+        self._tasks[upid] = {
+            'node': node, 'vmid': vmid, 'target': params['target'], 'started': self._now(),
+            'duration': self._rng.uniform(*self.duration),
+            'ok': self._rng.random() >= self.failure_rate, 'finished': False,
+        }
+        return upid
+
+    def _request(self, method, path, params):
+        segments = path.strip('/').split('/')
+
+        with self._lock:
+            if method == 'POST' and len(segments) == 5 and segments[0] == 'nodes' and segments[4] == 'migrate':
+                return self._migrate(segments[1], int(segments[3]), params)
+
+            if method == 'GET' and len(segments) == 5 and segments[0] == 'nodes' and segments[2] == 'tasks':
+                return self._task_status(segments[3])
+
+            if method == 'GET' and path == '/cluster/tasks':
+                return [self._task_status(upid) for upid in self._tasks]
+
+            response = self._replay(method, path, params)
+
+            # listings reflect the simulated migrations
+            if method == 'GET' and len(segments) == 3 and segments[0] == 'nodes' and segments[2] == 'qemu':
+                return [
+                    {key: value for key, value in vm.items() if key != 'node'}
+                    for vm in self._vms.values() if vm['node'] == segments[1]
+                ]
+
+            if method == 'GET' and path == '/cluster/resources':
+                return [r for r in response if r['type'] != 'qemu'] + [dict(vm, type='qemu') for vm in self._vms.values()]
+
+            return response
+
+class FakeAsyncProxmoxAPI:
+    """FakeProxmoxAPI with the interface of AsyncProxmoxAPI, for connections.pve_async."""
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self.loop.close()
+
+    async def get(self, path, **params):
+        return self.fake._request('GET', path, params)
+
+    async def post(self, path, **params):
+        return self.fake._request('POST', path, params)
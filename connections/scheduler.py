@@ -0,0 +1,340 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import math
+import time
+from collections import defaultdict, deque
+from dataclasses import replace
+
+from config import Vm2VmAffinityType
+
+def memory_demand(vm):
+    # memory a VM takes on its destination, stopped VMs take none
+    return vm.memory_used if vm.state == 'running' else 0
+
+def migration_bytes(vm):
+    # live migrations copy the used memory and the local disks
+    return memory_demand(vm) + vm.disk_max
+
+class AdaptiveConcurrency:
+    """Per node migration limits and throughput estimates.
+
+    Every finished migration is a throughput sample (bytes per second) of
+    its source and destination. With adaptive set, a node's limit grows by
+    one slot per limit's worth of migrations which reach at least half of
+    the best throughput seen on the node, a slower or failed migration
+    halves it (AIMD). Limits start at initial and stay within min_limit and
+    max_limit.
+    """
+
+    CONGESTION = 0.5
+
+    def __init__(self, initial, min_limit=1, max_limit=None, adaptive=False):
+        self.adaptive = adaptive
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit if max_limit is not None else initial, self.min_limit)
+        self.initial = min(max(initial, self.min_limit), self.max_limit) if adaptive else initial
+        self.limits = {}
+        self.rates = {} # moving average of the throughput per node
+        self.peaks = {}
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg.migration.max_migrations_per_host, cfg.migration.min_migrations_per_host,
+                   cfg.migration.max_adaptive_migrations_per_host, cfg.migration.adaptive_concurrency)
+
+    def limit(self, node):
+        return int(self.limits.get(node, self.initial))
+
+    def expected_rate(self, vm, dst_node):
+        """Throughput of a migration as measured on the slower of its nodes, 0 if unknown."""
+
+        rates = [self.rates[node] for node in (vm.node, dst_node) if node in self.rates]
+        if not rates and self.rates:
+            return sum(self.rates.values()) / len(self.rates)
+        return min(rates, default=0)
+
+    def finished(self, vm, dst_node, seconds, ok):
+        size = migration_bytes(vm)
+        if ok and not size:
+            return # nothing copied, nothing learned
+
+        rate = size / max(seconds, 1e-3)
+        for node in (vm.node, dst_node):
+            if ok:
+                self.rates[node] = (self.rates[node] + rate) / 2 if node in self.rates else rate
+                self.peaks[node] = max(self.peaks.get(node, 0), rate)
+            if not self.adaptive:
+                continue
+
+            limit = self.limits.get(node, self.initial)
+            if ok and rate >= self.CONGESTION * self.peaks[node]:
+                limit = min(limit + 1 / limit, self.max_limit)
+            else:
+                limit = max(limit / 2, self.min_limit)
+            self.limits[node] = limit
+
+class NodeMemory:
+    """Free memory of the nodes while migrations run.
+
+    A migration reserves the VM's memory on its destination when it starts,
+    the source gets it back once the migration succeeded. Nodes which are
+    not known are treated as having unlimited memory.
+    """
+
+    def __init__(self, nodes):
+        self.free = {node.name: node.memory_total - node.memory_used for node in nodes}
+        self.in_flight = 0
+
+    def fits(self, vm, dst_node):
+        return memory_demand(vm) <= self.free.get(dst_node, math.inf)
+
+    def reserve(self, vm, dst_node):
+        self.in_flight += 1
+        if dst_node in self.free:
+            self.free[dst_node] -= memory_demand(vm)
+
+    def release(self, vm, dst_node, ok):
+        self.in_flight -= 1
+        node = vm.node if ok else dst_node
+        if node in self.free:
+            self.free[node] += memory_demand(vm)
+
+def plan_migrations(nodes, migrations, cfg, allowed=None):
+    """Order migrations so that no destination runs out of memory.
+
+    Memory is simulated in rounds, each round starts every migration whose
+    destination has room for it and the sources get their memory back at
+    the end of the round. If nothing fits, the remaining migrations wait on
+    each other (e.g. two VMs swapping places between two full nodes), the
+    smallest one which fits somewhere then takes a detour over the node
+    with the most free memory it may legally run on: allowed maps VM ids to those node names
+    (the candidates of the model) and nodes running or receiving one of its
+    keep-apart peers are left out. Returns (vm, dst_node) hops in dispatch
+    order, the hops of one VM have to run one after the other.
+    """
+
+    memory = NodeMemory(nodes)
+    staging_nodes = [node.name for node in nodes if node.name not in cfg.maintenance.nodes]
+
+    # where the VMs are as the rounds go and where they end up
+    placement = {vm.id: node.name for node in nodes for vm in node.virtual_machines}
+    destinations = {vm.id: dst_node for vm, dst_node in migrations}
+    apart = defaultdict(set)
+    for rule in cfg.affinity_rules.vm_to_vm:
+        if rule.enabled and rule.type_ == Vm2VmAffinityType.KEEP_APART:
+            for vm_id in rule.virtual_machines:
+                apart[vm_id] |= rule.virtual_machines - {vm_id}
+
+    def may_stage(vm, node):
+        if node in (vm.node, destinations[vm.id]):
+            return False
+        if allowed is not None and node not in allowed.get(vm.id, ()):
+            return False
+        return all(node not in (placement.get(peer), destinations.get(peer)) for peer in apart[vm.id])
+
+    planned = []
+    pending = list(migrations)
+    staged = set()
+    while pending:
+        started = []
+        waiting = []
+        for vm, dst_node in pending:
+            if memory.fits(vm, dst_node):
+                memory.reserve(vm, dst_node)
+                started.append((vm, dst_node))
+            else:
+                waiting.append((vm, dst_node))
+
+        # the sources get their memory back once the round is done
+        for vm, dst_node in started:
+            memory.release(vm, dst_node, ok=True)
+            placement[vm.id] = dst_node
+        planned.extend(started)
+
+        if waiting and not started:
+            # the smallest VM with a legal node that fits it takes the detour
+            detour = None
+            if cfg.migration.staging:
+                for vm, dst_node in sorted(waiting, key=lambda m: memory_demand(m[0])):
+                    if vm.id in staged:
+                        continue
+
+                    staging_node = max((node for node in staging_nodes if may_stage(vm, node)),
+                                       key=lambda node: memory.free[node], default=None)
+                    if staging_node is not None and memory.fits(vm, staging_node):
+                        detour = (vm, dst_node)
+                        break
+
+            if detour is None:
+                # nothing left to try, the scheduler starts them as memory frees up
+                print(len(waiting), 'migrations wait for memory on their destination')
+                planned.extend(waiting)
+                break
+
+            vm, dst_node = detour
+            print('staging VM', vm.id, 'on', staging_node, 'on its way to', dst_node)
+            staged.add(vm.id)
+            planned.append((vm, staging_node))
+            memory.reserve(vm, staging_node)
+            memory.release(vm, staging_node, ok=True)
+            placement[vm.id] = staging_node
+            waiting[waiting.index(detour)] = (replace(vm, node=staging_node), dst_node)
+
+        pending = waiting
+
+    return planned
+
+class MigrationScheduler:
+    """Keep track of pending and running migrations.
+
+    Pending migrations are kept in one ready queue per source node, in the
+    order they were passed in. A migration is dispatched as soon as its source
+    and destination node have a free slot, so every poll cycle can start as
+    many migrations as the per node limit allows. Failed migrations are
+    retried at most max_retries times. Every finished task is kept in
+    completed as (vm, dst_node, seconds, ok).
+
+    Several migrations of the same VM (hops over a staging node) run in the
+    order they were passed in. If nodes is given, a migration additionally
+    waits until its destination has room for the VM.
+
+    With concurrency given, the per node limits come from it and learn from
+    every finished task. A bandwidth_budget (bytes per second) holds back
+    migrations while the expected throughput of the running ones would
+    exceed it, one migration always runs.
+    """
+
+    def __init__(self, migrations, max_migrations_per_host, max_retries=3, nodes=None, concurrency=None, bandwidth_budget=0):
+        self.max_migrations_per_host = max_migrations_per_host
+        self.max_retries = max_retries
+        self.memory = NodeMemory(nodes) if nodes is not None else None
+        self.concurrency = concurrency
+        self.bandwidth_budget = bandwidth_budget
+        self.rates = {} # vmid -> expected rate of its dispatched migration
+
+        # only the first hop of each VM is queued, the next one once it succeeded
+        self.queues = defaultdict(deque)
+        self.hops = {}
+        for vm, dst_node in migrations:
+            if vm.id in self.hops:
+                self.hops[vm.id].append((vm, dst_node))
+            else:
+                self.hops[vm.id] = deque()
+                self.queues[vm.node].append((vm, dst_node))
+
+        self.busy = defaultdict(int) # running migrations per node
+        self.attempts = defaultdict(int) # started migrations per VM
+        self.running = {} # task -> (vm, dst_node)
+        self.started_at = {}
+        self.completed = []
+        self.failed = []
+
+    @property
+    def num_pending(self):
+        return sum(len(queue) for queue in self.queues.values()) + sum(len(hops) for hops in self.hops.values())
+
+    @property
+    def done(self):
+        return not self.running and not self.num_pending
+
+    @property
+    def bandwidth(self):
+        # expected bytes per second of the dispatched migrations
+        return sum(self.rates.values())
+
+    def limit(self, node):
+        if self.concurrency is not None:
+            return self.concurrency.limit(node)
+        return self.max_migrations_per_host
+
+    def has_slot(self, node):
+        return self.busy[node] < self.limit(node)
+
+    def _expected_rate(self, vm, dst_node):
+        return self.concurrency.expected_rate(vm, dst_node) if self.concurrency is not None else 0
+
+    def fits(self, vm, dst_node):
+        # one migration always runs, whatever the budget
+        if self.bandwidth_budget and self.rates and self.bandwidth + self._expected_rate(vm, dst_node) > self.bandwidth_budget:
+            return False
+        return self.memory is None or self.memory.fits(vm, dst_node)
+
+    def _dispatch(self, vm, dst_node):
+        self.busy[vm.node] += 1
+        self.busy[dst_node] += 1
+        self.attempts[vm.id] += 1
+        self.rates[vm.id] = self._expected_rate(vm, dst_node)
+        if self.memory is not None:
+            self.memory.reserve(vm, dst_node)
+
+    def ready(self):
+        """Pop all migrations which can be started right now and reserve their slots."""
+
+        ready = []
+
+        for src_node, queue in self.queues.items():
+            if not queue or not self.has_slot(src_node):
+                continue
+
+            postponed = deque()
+            while queue and self.has_slot(src_node):
+                vm, dst_node = queue.popleft()
+                if not self.has_slot(dst_node) or not self.fits(vm, dst_node):
+                    postponed.append((vm, dst_node))
+                    continue
+
+                self._dispatch(vm, dst_node)
+                ready.append((vm, dst_node))
+
+            # keep the original order of everything not dispatched
+            postponed.extend(queue)
+            self.queues[src_node] = postponed
+
+        # nothing runs that could free memory, overcommit rather than stall
+        if not ready and not self.running and self.memory is not None:
+            for queue in self.queues.values():
+                if queue:
+                    vm, dst_node = queue.popleft()
+                    print('not enough memory on', dst_node, 'for VM', vm.id, 'migrating anyway')
+                    self._dispatch(vm, dst_node)
+                    ready.append((vm, dst_node))
+                    break
+
+        return ready
+
+    def started(self, task, vm, dst_node):
+        self.running[task] = (vm, dst_node)
+        self.started_at[task] = time.monotonic()
+
+    def _release(self, vm, dst_node, ok):
+        self.busy[vm.node] -= 1
+        self.busy[dst_node] -= 1
+        del self.rates[vm.id]
+        if self.memory is not None:
+            self.memory.release(vm, dst_node, ok)
+
+        if ok:
+            if self.hops[vm.id]: # continue with the next hop
+                next_vm, next_dst_node = self.hops[vm.id].popleft()
+                self.attempts[vm.id] = 0
+                self.queues[next_vm.node].append((next_vm, next_dst_node))
+            return
+
+        if self.attempts[vm.id] <= self.max_retries: # retry failed migrations first
+            self.queues[vm.node].appendleft((vm, dst_node))
+        else:
+            # the VM stays where it is, remaining hops are dropped
+            self.hops[vm.id].clear()
+            self.failed.append((vm, dst_node))
+
+    def start_failed(self, vm, dst_node):
+        self._release(vm, dst_node, ok=False)
+
+    def finished(self, task, ok):
+        vm, dst_node = self.running.pop(task)
+        seconds = time.monotonic() - self.started_at.pop(task)
+        self.completed.append((vm, dst_node, seconds, ok))
+        if self.concurrency is not None:
+            self.concurrency.finished(vm, dst_node, seconds, ok)
+        self._release(vm, dst_node, ok)
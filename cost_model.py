@@ -0,0 +1,128 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+from connections.scheduler import memory_demand
+
+GiB = 1024**3
+
+class MigrationLog:
+    """Finished migrations in a SQLite database."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS migrations (
+            time INTEGER NOT NULL,
+            vmid INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            memory INTEGER NOT NULL,
+            disk INTEGER NOT NULL,
+            seconds REAL NOT NULL,
+            ok INTEGER NOT NULL
+        )''')
+
+    def close(self):
+        self.db.close()
+
+    def add(self, migrations, now=None):
+        """Store the migrations recorded by CycleMetrics."""
+
+        now = int(now if now is not None else time.time())
+        with self.db:
+            self.db.executemany('INSERT INTO migrations VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                (now, m['vmid'], m['source'], m['target'], m['bytes'], m['disk'], m['seconds'], m['ok'])
+                for m in migrations
+            ])
+
+    def successful(self):
+        """(source, target, memory, disk, seconds) of every successful migration."""
+
+        return self.db.execute('SELECT source, target, memory, disk, seconds FROM migrations WHERE ok').fetchall()
+
+def fit(rows):
+    """Least squares fit of seconds = a + b * memory + c * disk (in GiB), None if underdetermined.
+
+    Sizes which are the same in all rows (e.g. no local disks at all) are
+    left out of the fit and get a coefficient of 0.
+    """
+
+    rows = np.array([row[2:] for row in rows], dtype=float)
+    features = np.column_stack([np.ones(len(rows)), rows[:, 0] / GiB, rows[:, 1] / GiB])
+
+    columns = [0] + [k for k in (1, 2) if np.ptp(features[:, k]) > 0]
+    if len(rows) <= len(columns) or np.linalg.matrix_rank(features[:, columns]) < len(columns):
+        return None
+
+    coefficients = np.zeros(3)
+    coefficients[columns], _, _, _ = np.linalg.lstsq(features[:, columns], rows[:, 2], rcond=None)
+    # neither overhead nor copying can save time
+    return np.maximum(coefficients, 0)
+
+def record(cfg, migrations):
+    log = MigrationLog(cfg.migration.cost_model_file)
+    try:
+        log.add(migrations)
+    finally:
+        log.close()
+
+class MigrationCostModel:
+    """Predict migration durations from the memory and disk bytes to copy.
+
+    Every source/destination pair with at least min_samples migrations
+    gets its own fit, all others use the fit over all migrations.
+    """
+
+    def __init__(self, observations, min_samples=10):
+        self.overall = fit(observations) if observations else None
+
+        pairs = {}
+        for row in observations:
+            pairs.setdefault((row[0], row[1]), []).append(row)
+
+        self.pairs = {}
+        for pair, rows in pairs.items():
+            if len(rows) >= min_samples:
+                coefficients = fit(rows)
+                if coefficients is not None:
+                    self.pairs[pair] = coefficients
+
+    @classmethod
+    def load(cls, cfg):
+        log = MigrationLog(cfg.migration.cost_model_file)
+        try:
+            return cls(log.successful(), cfg.migration.cost_model_min_samples)
+        finally:
+            log.close()
+
+    @property
+    def usable(self):
+        return self.overall is not None
+
+    def seconds(self, vm, dst_node=None):
+        coefficients = self.pairs.get((vm.node, dst_node), self.overall)
+        return coefficients @ [1, memory_demand(vm) / GiB, vm.disk_max / GiB]
+
+    def apply(self, nodes):
+        """Set the migration costs of all VMs, False if the model predicts no durations.
+
+        The predicted durations are scaled so that the cluster's total stays
+        that of the memory based costs, the objective weights keep their
+        meaning and the costs are only redistributed.
+        """
+
+        vms = [vm for node in nodes for vm in node.virtual_machines]
+        seconds = [self.seconds(vm) for vm in vms]
+        if not sum(seconds):
+            return False
+
+        scale = sum(vm.migration_cost() for vm in vms) / sum(seconds)
+        for vm, vm_seconds in zip(vms, seconds):
+            vm.migration_estimate = math.ceil(vm_seconds * scale)
+
+        return True
@@ -0,0 +1,90 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import hashlib
+import json
+import math
+import os
+
+from serde import to_dict
+
+def _digest(data):
+    # sets have no stable order, serialize them sorted
+    encoded = json.dumps(data, sort_keys=True, default=sorted).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+def fingerprint(nodes, cfg):
+    """Summarize the inputs of a solve.
+
+    structure covers everything which changes the model or the plan (VM
+    set, placement, node sizes, rules, maintenance, model, solver and
+    migration settings),
+    usage the cpu and memory costs of every VM, bucketed so that noise does
+    not count as change.
+    """
+
+    cpu_bucket = cfg.change_detection.cpu_bucket
+    memory_bucket = cfg.change_detection.memory_bucket
+
+    structure = {
+        'nodes': sorted((node.name, node.memory_total, node.num_cpu) for node in nodes),
+        'vms': sorted(
+            (vm.id, node.name, vm.state, vm.locked, vm.memory_max, vm.cpu_max)
+            for node in nodes for vm in node.virtual_machines
+        ),
+        'affinity_rules': to_dict(cfg.affinity_rules),
+        'maintenance': to_dict(cfg.maintenance),
+        'model': to_dict(cfg.model),
+        'solver': to_dict(cfg.solver),
+        'migration': to_dict(cfg.migration),
+    }
+
+    usage = {
+        str(vm.id): [vm.cpu_cost() // cpu_bucket, vm.memory_cost() // memory_bucket]
+        for node in nodes for vm in node.virtual_machines
+    }
+
+    return {
+        'structure': _digest(structure),
+        'cpu_bucket': cpu_bucket,
+        'memory_bucket': memory_bucket,
+        'usage': usage,
+    }
+
+def difference(previous, current):
+    """Fraction of the cluster's cpu or memory usage which moved between buckets, inf on structural changes."""
+
+    if (previous['structure'] != current['structure']
+            or previous['cpu_bucket'] != current['cpu_bucket']
+            or previous['memory_bucket'] != current['memory_bucket']):
+        return math.inf
+
+    usage = current['usage']
+    total_cpu = sum(cpu for cpu, _ in usage.values()) or 1
+    total_memory = sum(memory for _, memory in usage.values()) or 1
+
+    cpu_change = sum(abs(cpu - previous['usage'][vm_id][0]) for vm_id, (cpu, _) in usage.items())
+    memory_change = sum(abs(memory - previous['usage'][vm_id][1]) for vm_id, (_, memory) in usage.items())
+
+    return max(cpu_change / total_cpu, memory_change / total_memory)
+
+def load(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def clear(path):
+    # the next run solves whatever the cluster looks like
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def save(path, data):
+    # replace the file atomically so that an interrupted write never leaves a broken state
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
@@ -0,0 +1,368 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import time
+from copy import copy
+
+import numpy as np
+
+import config
+
+class HeuristicBalancer:
+    """Greedy best-fit placement improved by a move/swap local search.
+
+    Works on the cost table, candidates and rules of an ARSModel and
+    minimizes the same objective: weighted cpu/memory distances of every
+    node to its target in the configured mode (exact squares for piecewise)
+    plus the migration costs. VMs which have to be
+    kept together are placed as one item with their summed costs.
+    """
+
+    def __init__(self, ars, seed=0):
+        self.ars = ars
+        self.rng = np.random.default_rng(seed)
+
+        costs = ars.costs
+        num_nodes = len(ars.node_list)
+
+        self.node_positions = {node.name: j for j, (_, node) in enumerate(ars.node_list)}
+        vm_positions = {vm.id: i for i, (_, vm) in enumerate(ars.vms)}
+
+        # collapse keep-together groups into single items
+        item_of = list(range(len(ars.vms)))
+
+        def find(i):
+            while item_of[i] != i:
+                i = item_of[i]
+            return i
+
+        for rule in ars.cfg.affinity_rules.vm_to_vm:
+            if rule.enabled and rule.type_ == config.Vm2VmAffinityType.KEEP_TOGETHER:
+                members = [vm_positions[vm_id] for vm_id in rule.virtual_machines if vm_id in vm_positions]
+                for i in members[1:]:
+                    item_of[find(i)] = find(members[0])
+
+        items = {}
+        for i in range(len(ars.vms)):
+            items.setdefault(find(i), []).append(i)
+        self.items = list(items.values())
+        item_positions = {i: item for item, members in enumerate(self.items) for i in members}
+
+        self.cpu = np.array([sum(costs.vm_cpu[i] for i in members) for members in self.items], dtype=float)
+        self.mem = np.array([sum(costs.vm_memory[i] for i in members) for members in self.items], dtype=float)
+        self.used = np.array([sum(costs.vm_memory_used[i] for i in members) for members in self.items], dtype=np.int64)
+
+        # migration costs of moving an item to each node
+        self.move_cost = np.zeros((len(self.items), num_nodes))
+        for item, members in enumerate(self.items):
+            for i in members:
+                self.move_cost[item] += costs.vm_migration[i]
+                current = self.node_positions.get(ars.vms[i][1].node)
+                if current is not None:
+                    self.move_cost[item, current] -= costs.vm_migration[i]
+
+        # all members of an item share the same candidates
+        self.allowed = np.zeros((len(self.items), num_nodes), dtype=bool)
+        for item, members in enumerate(self.items):
+            self.allowed[item, ars.candidates[members[0]]] = True
+
+        self.capacity = np.array([costs.capacity(j) for j in range(num_nodes)], dtype=np.int64)
+
+        targets = [costs.target(j) for j in range(num_nodes)]
+        self.cpu_target = np.array([t[2] for t in targets], dtype=float)
+        self.mem_target = np.array([t[3] for t in targets], dtype=float)
+
+        self.mode = ars.cfg.model.objective
+        self.cpu_weight, self.mem_weight, migration_weight = ars.objective_weights()
+        self.move_cost *= migration_weight
+        # piecewise squares are divided by the cluster totals
+        self.cpu_bound = max(1, costs.total_cpu)
+        self.mem_bound = max(1, costs.total_memory)
+
+        # keep-apart rules as lists of items
+        self.apart_rules = []
+        for rule in ars.cfg.affinity_rules.vm_to_vm:
+            if rule.enabled and rule.type_ == config.Vm2VmAffinityType.KEEP_APART:
+                members = {item_positions[vm_positions[vm_id]] for vm_id in rule.virtual_machines if vm_id in vm_positions}
+                if len(members) > 1:
+                    self.apart_rules.append(sorted(members))
+
+        self.item_rules = [[] for _ in self.items]
+        for r, members in enumerate(self.apart_rules):
+            for item in members:
+                self.item_rules[item].append(r)
+
+        # VMs and memory moved by placing an item on each node and the
+        # current nodes of its members, only needed for migration limits
+        self.limits = ars.limits
+        if self.limits.enabled:
+            self.item_moves = np.zeros((len(self.items), num_nodes), dtype=np.int64)
+            self.item_moved_memory = np.zeros((len(self.items), num_nodes), dtype=np.int64)
+            self.item_sources = []
+            for item, members in enumerate(self.items):
+                sources = {}
+                for i in members:
+                    self.item_moves[item] += 1
+                    self.item_moved_memory[item] += costs.vm_memory_used[i]
+                    current = self.node_positions.get(ars.vms[i][1].node)
+                    if current is not None:
+                        self.item_moves[item, current] -= 1
+                        self.item_moved_memory[item, current] -= costs.vm_memory_used[i]
+                        sources[current] = sources.get(current, 0) + 1
+                self.item_sources.append(sources)
+
+    def _place(self, item, j):
+        self.placement[item] = j
+        self.cpu_load[j] += self.cpu[item]
+        self.mem_load[j] += self.mem[item]
+        self.used_load[j] += self.used[item]
+        for r in self.item_rules[item]:
+            self.apart[r, j] += 1
+        if self.limits.enabled:
+            self._count_moves(item, j, 1)
+
+    def _unplace(self, item):
+        j = self.placement[item]
+        self.placement[item] = -1
+        self.cpu_load[j] -= self.cpu[item]
+        self.mem_load[j] -= self.mem[item]
+        self.used_load[j] -= self.used[item]
+        for r in self.item_rules[item]:
+            self.apart[r, j] -= 1
+        if self.limits.enabled:
+            self._count_moves(item, j, -1)
+
+    def _count_moves(self, item, j, sign):
+        self.moves += sign * self.item_moves[item, j]
+        self.moved_memory += sign * self.item_moved_memory[item, j]
+        self.inbound[j] += sign * self.item_moves[item, j]
+        for c, n in self.item_sources[item].items():
+            if c != j:
+                self.outbound[c] += sign * n
+
+    def _distances(self, deviation, bound):
+        # distance of every node to its target in the configured mode
+        if self.mode == config.ObjectiveMode.SQUARED:
+            return deviation**2
+        if self.mode == config.ObjectiveMode.PIECEWISE:
+            return deviation**2 / bound
+        return np.abs(deviation)
+
+    def _balance(self, cpu_deviation, mem_deviation):
+        # weighted distances of deviations with the nodes along the last axis
+        cpu = self._distances(cpu_deviation, self.cpu_bound)
+        mem = self._distances(mem_deviation, self.mem_bound)
+        if self.mode == config.ObjectiveMode.MINMAX:
+            return self.cpu_weight * cpu.max(axis=-1, initial=0) + self.mem_weight * mem.max(axis=-1, initial=0)
+        return self.cpu_weight * cpu.sum(axis=-1) + self.mem_weight * mem.sum(axis=-1)
+
+    def _node_delta(self, j, d_cpu, d_mem):
+        # change of the distances of nodes j when their load changes by d_cpu, d_mem
+        cpu_deviation = self.cpu_load[j] - self.cpu_target[j]
+        mem_deviation = self.mem_load[j] - self.mem_target[j]
+        return (self.cpu_weight * (self._distances(cpu_deviation + d_cpu, self.cpu_bound) - self._distances(cpu_deviation, self.cpu_bound))
+                + self.mem_weight * (self._distances(mem_deviation + d_mem, self.mem_bound) - self._distances(mem_deviation, self.mem_bound)))
+
+    def _add_delta(self, item):
+        # objective change of adding the item to every node
+        cpu, mem = self.cpu[item], self.mem[item]
+        if self.mode != config.ObjectiveMode.MINMAX:
+            return self._node_delta(slice(None), cpu, mem)
+
+        # the largest distance may be on any node, every row adds the item to another one
+        cpu_deviation = self.cpu_load - self.cpu_target
+        mem_deviation = self.mem_load - self.mem_target
+        added = np.eye(len(cpu_deviation))
+        return (self._balance(cpu_deviation + added * cpu, mem_deviation + added * mem)
+                - self._balance(cpu_deviation, mem_deviation))
+
+    def _feasible(self, item):
+        # nodes the (unplaced) item may be added to
+        feasible = self.allowed[item] & (self.used_load + self.used[item] <= self.capacity)
+        for r in self.item_rules[item]:
+            feasible &= self.apart[r] == 0
+
+        limits = self.limits
+        if limits.enabled:
+            if limits.migrations is not None:
+                feasible &= self.moves + self.item_moves[item] <= limits.migrations
+            if limits.memory is not None:
+                feasible &= self.moved_memory + self.item_moved_memory[item] <= limits.memory
+            if limits.inbound is not None:
+                feasible &= self.inbound + self.item_moves[item] <= self.max_inbound
+            if limits.outbound is not None:
+                # members whose node cannot lose any more VMs have to stay
+                for c, n in self.item_sources[item].items():
+                    if self.outbound[c] + n > self.max_outbound[c]:
+                        feasible &= np.arange(len(feasible)) == c
+        return feasible
+
+    def _within_limits(self):
+        limits = self.limits
+        return ((limits.migrations is None or self.moves <= limits.migrations)
+                and (limits.memory is None or self.moved_memory <= limits.memory)
+                and (limits.inbound is None or (self.inbound <= self.max_inbound).all())
+                and (limits.outbound is None or (self.outbound <= self.max_outbound).all()))
+
+    def _initial_placement(self, start):
+        num_nodes = len(self.ars.node_list)
+
+        self.placement = np.full(len(self.items), -1)
+        self.cpu_load = np.zeros(num_nodes)
+        self.mem_load = np.zeros(num_nodes)
+        self.used_load = np.zeros(num_nodes, dtype=np.int64)
+        self.apart = np.zeros((len(self.apart_rules), num_nodes), dtype=np.int64)
+
+        self.moves = 0
+        self.moved_memory = 0
+        self.inbound = np.zeros(num_nodes, dtype=np.int64)
+        self.outbound = np.zeros(num_nodes, dtype=np.int64)
+        if self.limits.inbound is not None:
+            self.max_inbound = np.array(self.limits.inbound, dtype=np.int64)
+        if self.limits.outbound is not None:
+            self.max_outbound = np.array(self.limits.outbound, dtype=np.int64)
+
+        # keep items where they are as long as this is feasible, largest first
+        unplaced = []
+        for item in sorted(range(len(self.items)), key=lambda item: -self.used[item]):
+            nodes = {start[self.ars.vms[i][1].id] for i in self.items[item]}
+            j = self.node_positions.get(nodes.pop()) if len(nodes) == 1 else None
+            if j is not None and self._feasible(item)[j]:
+                self._place(item, j)
+            else:
+                unplaced.append(item)
+
+        # best fit for everything else
+        for item in unplaced:
+            feasible = self._feasible(item)
+            if not feasible.any():
+                return False
+
+            delta = self._add_delta(item) + self.move_cost[item]
+            if self.limits.enabled: # leave as much of the limits as possible to the search
+                feasible &= self.item_moves[item] == self.item_moves[item, feasible].min()
+            self._place(item, int(np.argmin(np.where(feasible, delta, np.inf))))
+
+        return True
+
+    def _move(self, item):
+        a = self.placement[item]
+        self._unplace(item)
+
+        feasible = self._feasible(item)
+        delta = self._add_delta(item) + self.move_cost[item]
+        delta = np.where(feasible, delta, np.inf)
+
+        j = int(np.argmin(delta))
+        improved = j != a and delta[j] < delta[a]
+        self._place(item, j if improved else a)
+        return improved
+
+    def _swap(self, item, sample_size=256):
+        if self.item_rules[item]:
+            return False
+
+        a = self.placement[item]
+        others = self.rng.choice(len(self.items), size=min(sample_size, len(self.items)), replace=False)
+        others = others[(self.placement[others] != a) & np.array([not self.item_rules[q] for q in others], dtype=bool)]
+        if not len(others):
+            return False
+
+        b = self.placement[others]
+
+        # objective change on both nodes
+        d_cpu = self.cpu[others] - self.cpu[item]
+        d_mem = self.mem[others] - self.mem[item]
+        if self.mode != config.ObjectiveMode.MINMAX:
+            delta = self._node_delta(a, d_cpu, d_mem) + self._node_delta(b, -d_cpu, -d_mem)
+        else:
+            rows = np.arange(len(others))
+            cpu_deviation = np.tile(self.cpu_load - self.cpu_target, (len(others), 1))
+            mem_deviation = np.tile(self.mem_load - self.mem_target, (len(others), 1))
+            before = self._balance(cpu_deviation[0], mem_deviation[0])
+            cpu_deviation[:, a] += d_cpu
+            cpu_deviation[rows, b] -= d_cpu
+            mem_deviation[:, a] += d_mem
+            mem_deviation[rows, b] -= d_mem
+            delta = self._balance(cpu_deviation, mem_deviation) - before
+        delta += (self.move_cost[item, b] - self.move_cost[item, a]
+                  + self.move_cost[others, a] - self.move_cost[others, b])
+
+        d_used = self.used[others] - self.used[item]
+        feasible = (self.allowed[item, b] & self.allowed[others, a]
+                    & (self.used_load[a] + d_used <= self.capacity[a])
+                    & (self.used_load[b] - d_used <= self.capacity[b]))
+        delta = np.where(feasible, delta, np.inf)
+
+        k = int(np.argmin(delta))
+        if delta[k] >= 0:
+            return False
+
+        other = others[k]
+        self._unplace(item)
+        self._unplace(other)
+        self._place(item, b[k])
+        self._place(other, a)
+
+        # a swap moves two items at once, undo it if that exceeds the limits
+        if self.limits.enabled and not self._within_limits():
+            self._unplace(item)
+            self._unplace(other)
+            self._place(item, a)
+            self._place(other, b[k])
+            return False
+
+        return True
+
+    def objective(self):
+        return (self._balance(self.cpu_load - self.cpu_target, self.mem_load - self.mem_target)
+                + self.move_cost[np.arange(len(self.items)), self.placement].sum())
+
+    def solve(self, hint=None, time_limit=1.0):
+        """Calculate a placement (VM id -> node name), None if no feasible one was found."""
+
+        deadline = time.monotonic() + time_limit
+
+        if not self._initial_placement(self.ars.placement_hint(hint)):
+            return None
+
+        while time.monotonic() < deadline:
+            improved = False
+            for item in self.rng.permutation(len(self.items)):
+                improved |= self._move(item)
+                if time.monotonic() >= deadline:
+                    break
+
+            # only try swaps once no single move improves
+            if not improved:
+                for item in self.rng.permutation(len(self.items)):
+                    improved |= self._swap(item)
+                    if time.monotonic() >= deadline:
+                        break
+
+            if not improved:
+                break
+
+        if self.ars.cfg.metrics.verbose:
+            print('heuristic', 'objective', int(self.objective()), sep='\t')
+
+        node_names = [node.name for _, node in self.ars.node_list]
+        return {
+            self.ars.vms[i][1].id: node_names[self.placement[item]]
+            for item, members in enumerate(self.items) for i in members
+        }
+
+    def calculate_balanced_state(self, hint=None, time_limit=1.0):
+        placement = self.solve(hint, time_limit)
+        if placement is None:
+            return None
+
+        result = {}
+        for _, node in self.ars.node_list:
+            result[node.name] = copy(node)
+            result[node.name].virtual_machines = []
+
+        for _, vm in self.ars.vms:
+            result[placement[vm.id]].virtual_machines.append(vm)
+
+        return list(result.values())
@@ -0,0 +1,125 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+import config
+
+class UsageHistory:
+    """Cpu and memory samples of VMs in a SQLite database, keyed by VM id and time."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS samples (
+            vmid INTEGER NOT NULL,
+            time INTEGER NOT NULL,
+            cpu REAL NOT NULL,
+            mem REAL NOT NULL,
+            PRIMARY KEY (vmid, time)
+        ) WITHOUT ROWID''')
+
+    def close(self):
+        self.db.close()
+
+    def newest(self):
+        """Time of the newest sample of every VM."""
+
+        return dict(self.db.execute('SELECT vmid, MAX(time) FROM samples GROUP BY vmid'))
+
+    def add(self, samples):
+        """Store (vmid, time, cpu, mem) samples, known ones are ignored."""
+
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?)', samples)
+
+    def prune(self, before):
+        with self.db:
+            self.db.execute('DELETE FROM samples WHERE time < ?', (before,))
+
+    def load(self, since):
+        """All samples since a point in time as arrays of vmids, times, cpu and memory usage."""
+
+        rows = self.db.execute('SELECT vmid, time, cpu, mem FROM samples WHERE time >= ? ORDER BY vmid, time', (since,)).fetchall()
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+
+        vmids, times, cpu, mem = zip(*rows)
+        return np.array(vmids, dtype=np.int64), np.array(times, dtype=np.int64), np.array(cpu), np.array(mem)
+
+def percentile(groups, values, q):
+    """Nearest rank q-th percentile of values per group, groups are numbered from 0."""
+
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups)
+    starts = np.cumsum(counts) - counts
+    ranks = starts + np.maximum(np.ceil(q / 100 * counts).astype(np.int64) - 1, 0)
+    return values[order][ranks]
+
+def ewma(groups, times, values, half_life, now):
+    """Mean of values per group, each weighted by its age so that the weight halves every half_life seconds."""
+
+    weights = 0.5 ** ((now - times) / half_life)
+    return np.bincount(groups, weights * values) / np.bincount(groups, weights)
+
+def demand(vmids, times, cpu, mem, cfg, now):
+    """Cpu and memory demand of every VM with samples as {vmid: (cpu, mem)}."""
+
+    if not len(vmids):
+        return {}
+
+    ids, groups = np.unique(vmids, return_inverse=True)
+    if cfg.history.demand == config.DemandMode.EWMA:
+        cpu_demand = ewma(groups, times, cpu, cfg.history.half_life, now)
+        mem_demand = ewma(groups, times, mem, cfg.history.half_life, now)
+    else:
+        cpu_demand = percentile(groups, cpu, cfg.history.percentile)
+        mem_demand = percentile(groups, mem, cfg.history.percentile)
+
+    return {int(vmid): (float(c), math.ceil(m)) for vmid, c, m in zip(ids, cpu_demand, mem_demand)}
+
+def rrd_samples(vmid, rrddata, after):
+    # samples holding both cpu and memory usage newer than the stored ones
+    return [(vmid, int(data['time']), data['cpu'], data['mem'])
+            for data in rrddata if data['time'] > after and 'cpu' in data and 'mem' in data]
+
+def update(nodes, connector, pve, cfg, now=None):
+    """Store the usage of the running VMs and set their demand.
+
+    The current usage of every running VM is stored as a sample. rrddata is
+    only fetched for VMs whose newest stored sample is older than
+    backfill_after, of which only the samples newer than the stored ones
+    are added. Returns the number of VMs backfilled from rrddata.
+    """
+
+    now = int(now if now is not None else time.time())
+    running = [vm for node in nodes for vm in node.virtual_machines if vm.state == 'running']
+
+    history = UsageHistory(cfg.history.file)
+    try:
+        newest = history.newest()
+
+        targets = [(vm.node, vm.id) for vm in running if newest.get(vm.id, 0) < now - cfg.history.backfill_after]
+        rrddata = connector.fetch_rrddata(pve, targets, cfg.connection.max_workers) if targets else {}
+
+        samples = []
+        for (_, vmid), data in rrddata.items():
+            if data is not None:
+                samples += rrd_samples(vmid, data, newest.get(vmid, 0))
+        samples += [(vm.id, now, vm.cpu_used, vm.memory_used) for vm in running]
+        history.add(samples)
+
+        since = now - cfg.history.window
+        history.prune(since)
+        vm_demand = demand(*history.load(since), cfg, now)
+    finally:
+        history.close()
+
+    for vm in running:
+        if vm.id in vm_demand:
+            vm.cpu_demand, vm.memory_demand = vm_demand[vm.id]
+
+    return len(targets)
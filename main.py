@@ -1,19 +1,30 @@
 # Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
 # SPDX-License-Identifier: GPL-3.0
 
+import argparse
+import contextlib
+import copy
+import fcntl
 import math
+import os
+import random
 from proxmoxer import ProxmoxAPI
 from proxmoxer.core import ResourceException as ProxmoxerResourceException
 from pprint import pprint
 import time
 import logging
-from config import Config
+from config import Config, ConnectionBackend
 import urllib3
 import sys
 
+import cost_model
+import fingerprint
+import history
+from metrics import CycleMetrics
 from ars_model import ARSModel
 from model import *
 from connections import pve as proxmox
+from connections import replay
 
 def build_migrations(old, new):
     vmid_vm_map = {vm.id: vm for node in old for vm in node.virtual_machines}
@@ -23,27 +34,109 @@ def build_migrations(old, new):
 
     return [ (vmid_vm_map[vmid], dst_node) for vmid, dst_node in migrations ]
 
-def main():
-    config = Config.from_file('ars.cfg')
-    if not config.general.verify_ssl:
-        print("WARNING:  Unverified HTTPS request are being made. Adding certificate verification is strongly advised.")
+CONFIG_FILE = 'ars.cfg'
 
-    pve = ProxmoxAPI(host=config.general.host, user=config.general.user,
-                     password=config.general.password, verify_ssl=config.general.verify_ssl)
+def connect(config, args=None):
+    replay_file = args.replay if args is not None else None
+    record_file = args.record if args is not None else None
 
-    # logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-    # logger.setLevel(logging.INFO)
+    if replay_file is not None:
+        pve = replay.FakeProxmoxAPI.from_file(
+            replay_file, duration=args.task_duration, failure_rate=args.failure_rate, speedup=args.speedup,
+        )
+
+    if config.connection.backend == ConnectionBackend.ASYNC:
+        from connections import pve_async as connector
+        if record_file is not None:
+            sys.exit("--record requires the proxmoxer backend")
+
+        if replay_file is not None:
+            pve = replay.FakeAsyncProxmoxAPI(pve)
+        else:
+            pve = connector.AsyncProxmoxAPI.from_config(config)
+    else:
+        connector = proxmox
+        if replay_file is None:
+            pve = ProxmoxAPI(host=config.general.host, user=config.general.user,
+                             password=config.general.password, verify_ssl=config.general.verify_ssl)
+
+        if record_file is not None:
+            pve = replay.Recorder(pve, record_file)
+
+    return connector, pve
 
+@contextlib.contextmanager
+def cycle_lock(path):
+    """Hold an exclusive lock on path, yields False if another instance holds it."""
+
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def run_cycle(config, connector, pve, logger, hint=None, evacuate=False):
+    """Fetch the current state, balance it and migrate.
+
+    With evacuate only the VMs on maintenance nodes are moved. Returns the
+    new (or unchanged current) state, None if there is none.
+    """
+
+    metrics = CycleMetrics()
+    try:
+        return _run_cycle(config, connector, pve, logger, hint, metrics, evacuate)
+    finally:
+        metrics.export(config)
+
+def _run_cycle(config, connector, pve, logger, hint, metrics, evacuate=False):
     # fetch current vm-to-host mappings
-    state = proxmox.fetch_current_state(pve)
+    with metrics.phase('fetch'):
+        state = connector.fetch_current_state(pve, config)
+    metrics.set('nodes', len(state))
+    metrics.set('vms', sum(len(node.virtual_machines) for node in state))
+
+    # place VMs by their demand over the stored usage instead of the latest sample
+    if config.history.enabled:
+        with metrics.phase('history'):
+            metrics.set('history_backfilled', history.update(state, connector, pve, config))
+
+    # migration costs predicted from the durations of past migrations
+    costs = None
+    if config.migration.cost_model:
+        costs = cost_model.MigrationCostModel.load(config)
+        if not costs.usable or not costs.apply(state):
+            print("too few migrations for the cost model, using memory based costs")
+            costs = None
 
-    ars = ARSModel(state, config)
+    # skip the solve if nothing changed materially since the last run
+    if config.change_detection.enabled and not evacuate:
+        current = fingerprint.fingerprint(state, config)
+        previous = fingerprint.load(config.change_detection.state_file)
+        if previous is not None:
+            change = fingerprint.difference(previous, current)
+            if change <= config.change_detection.tolerance:
+                print("skipped, no material change ({:.3f})".format(change))
+                return state
+
+    ars = ARSModel(state, config, metrics=metrics)
 
     # calculate an optimal state based based on that
-    new_state = ars.calculate_balanced_state()
+    if evacuate:
+        new_state = ars.calculate_evacuation_state()
+    else:
+        new_state = ars.calculate_balanced_state(hint)
+    if new_state is None:
+        print("no feasible state found")
+        return None
 
-    migrations = build_migrations(state, new_state)
+    with metrics.phase('diff'):
+        migrations = build_migrations(state, new_state)
 
     print()
     print("state")
@@ -74,21 +167,136 @@ def main():
 
     # migrations = sort_migrations_by_best(migrations)
     #
-    migrations = sorted(migrations, key=lambda x: x[0].migration_cost())
+    if costs is not None: # fastest first
+        migrations = sorted(migrations, key=lambda x: costs.seconds(*x))
+    else:
+        migrations = sorted(migrations, key=lambda x: x[0].migration_cost())
     print()
     # pprint(migrations)
     print("len(migrations)", len(migrations))
     print("cost(migrations)", sum([migration[0].migration_cost() for migration in migrations]))
 
     migration_cost = sum([migration[0].migration_cost() for migration in migrations])
-    if migration_cost < 30000:
+    metrics.set('migrations_planned', len(migrations))
+    metrics.set('migration_cost', migration_cost)
+    if migration_cost < 30000 and not evacuate:
         print("skipped, below threshold")
-        sys.exit(0)
+        if config.change_detection.enabled:
+            fingerprint.save(config.change_detection.state_file, current)
+        return new_state
     # sys.exit(1)
 
-    proxmox.realize_migrations(logger, pve, migrations, cfg=config)
+    # drain the maintenance nodes as fast as the cluster allows
+    migration_config = config
+    if evacuate:
+        migration_config = copy.deepcopy(config)
+        migration_config.migration.max_migrations_per_host = config.maintenance.evacuate_migrations_per_host
+
+    with metrics.phase('execute'):
+        connector.realize_migrations(logger, pve, migrations, cfg=migration_config, metrics=metrics, nodes=state,
+                                     allowed=ars.allowed_nodes())
     print("finished")
 
+    if config.migration.cost_model:
+        cost_model.record(config, metrics.migrations)
+
+    # compare the next run against the planned state, failed migrations
+    # show up as changed placement. A plan held back by the migration
+    # limits is only a step, the next run continues from where it ended
+    if config.change_detection.enabled:
+        placement = {vm.id: node.name for node in new_state for vm in node.virtual_machines}
+        if not evacuate and ars.limits_reached(placement):
+            print("migration limits reached, solving again next run")
+            fingerprint.clear(config.change_detection.state_file)
+        else:
+            fingerprint.save(config.change_detection.state_file, fingerprint.fingerprint(new_state, config))
+    return new_state
+
+def run_daemon(logger, args):
+    """Run a cycle every interval seconds, keeping session, config and last solution between cycles."""
+
+    config_mtime = os.stat(CONFIG_FILE).st_mtime
+    config = Config.from_file(CONFIG_FILE)
+    connector, pve = None, None
+    hint = None
+
+    next_cycle = time.monotonic()
+    while True:
+        # reload the configuration only if it has been changed
+        mtime = os.stat(CONFIG_FILE).st_mtime
+        if mtime != config_mtime:
+            try:
+                new_config = Config.from_file(CONFIG_FILE)
+            except Exception as e:
+                print("keeping previous configuration {!r}".format(e))
+            else:
+                if pve is not None and (new_config.general != config.general or new_config.connection != config.connection):
+                    connector.close(pve)
+                    connector, pve = None, None
+                config = new_config
+            config_mtime = mtime
+
+        with cycle_lock(config.daemon.lock_file) as locked:
+            if not locked:
+                print("another cycle is still running, skipped")
+            else:
+                try:
+                    if pve is None:
+                        connector, pve = connect(config, args)
+                    hint = run_cycle(config, connector, pve, logger, hint) or hint
+                except Exception:
+                    logger.exception("cycle failed")
+                    # start over with a new session
+                    if pve is not None:
+                        connector.close(pve)
+                    connector, pve = None, None
+
+        # never stack cycles, skip the ones missed by a slow cycle
+        interval = config.daemon.interval
+        next_cycle += interval
+        now = time.monotonic()
+        if now > next_cycle:
+            missed = math.ceil((now - next_cycle) / interval)
+            print("skipped", missed, "cycles")
+            next_cycle += missed * interval
+
+        time.sleep(next_cycle - now + random.uniform(0, config.daemon.jitter))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true', help='keep running and balance every [daemon] interval seconds')
+    parser.add_argument('--evacuate', action='store_true', help='only move the VMs off the [maintenance] nodes')
+    parser.add_argument('--record', metavar='FILE', help='append all API requests and responses to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='answer API requests from a recording and simulate migrations')
+    parser.add_argument('--task-duration', nargs=2, type=float, default=[5.0, 30.0], metavar=('MIN', 'MAX'),
+                        help='replay only: range of simulated migration durations in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='replay only: share of failing migrations')
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay only: run simulated time faster')
+    args = parser.parse_args()
+
+    config = Config.from_file(CONFIG_FILE)
+    if not config.general.verify_ssl:
+        print("WARNING:  Unverified HTTPS request are being made. Adding certificate verification is strongly advised.")
+
+    # logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    # logger.setLevel(logging.INFO)
+
+    if args.daemon:
+        if args.evacuate:
+            sys.exit("--evacuate runs a single cycle")
+        run_daemon(logger, args)
+        return
+
+    with cycle_lock(config.daemon.lock_file) as locked:
+        if not locked:
+            print("another cycle is still running, skipped")
+            sys.exit(0)
+
+        connector, pve = connect(config, args)
+        if run_cycle(config, connector, pve, logger, evacuate=args.evacuate) is None:
+            sys.exit(1)
+
 if __name__ == '__main__':
     urllib3.disable_warnings() # disable ssl warnings, we warn elsewhere
     main()
@@ -0,0 +1,120 @@
+# Copyright (c) 2022 Armin Fisslthaler <armin@fisslthaler.net>, All rights reserved.
+# SPDX-License-Identifier: GPL-3.0
+
+import contextlib
+import json
+import os
+import re
+import time
+
+# CP-SAT logs when presolve is done and the search begins
+SEARCH_START = re.compile(r'Starting search at ([0-9.]+)s')
+
+class CycleMetrics:
+    """Timings and counters of one balancing cycle.
+
+    phases holds seconds spent in fetch, build, presolve, solve, diff and
+    execute, values holds scalar values like model size or number of
+    migrations, timeline the (seconds, objective) of every improving
+    solution and migrations one entry per finished migration task.
+    """
+
+    def __init__(self):
+        self.timestamp = time.time()
+        self.phases = {}
+        self.values = {}
+        self.timeline = []
+        self.migrations = []
+        self.search_start = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def solution(self, seconds, objective):
+        self.timeline.append((seconds, objective))
+
+    def solver_log(self, line):
+        match = SEARCH_START.search(line)
+        if match:
+            self.search_start = float(match.group(1))
+
+    def solved(self, wall_time):
+        # split the solver's wall time at the start of the search
+        presolve = min(self.search_start or 0, wall_time)
+        self.add_phase('presolve', presolve)
+        self.add_phase('solve', wall_time - presolve)
+        self.search_start = None
+
+    def migration(self, vm, dst_node, seconds, ok):
+        # live migrations copy the VM's memory
+        self.migrations.append({
+            'vmid': vm.id, 'source': vm.node, 'target': dst_node, 'seconds': seconds, 'ok': ok,
+            'bytes': vm.memory_used if vm.state == 'running' else 0, 'disk': vm.disk_max,
+        })
+
+    def as_dict(self):
+        values = dict(self.values)
+        done = [m for m in self.migrations if m['ok']]
+        values['migrations_done'] = len(done)
+        values['migrations_failed'] = len(self.migrations) - len(done)
+        values['migrated_bytes'] = sum(m['bytes'] for m in done)
+
+        return {
+            'timestamp': self.timestamp,
+            'phases': self.phases,
+            'values': values,
+            'timeline': self.timeline,
+            'migrations': self.migrations,
+        }
+
+    def write_json_lines(self, path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.as_dict()) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the cycle in the text format of the node exporter's textfile collector."""
+
+        data = self.as_dict()
+        durations = [m['seconds'] for m in self.migrations]
+
+        lines = [
+            '# HELP ars_phase_seconds Seconds spent in each phase of the last cycle.',
+            '# TYPE ars_phase_seconds gauge',
+        ]
+        lines += ['ars_phase_seconds{{phase="{}"}} {}'.format(name, seconds) for name, seconds in sorted(data['phases'].items())]
+
+        for name, value in sorted(data['values'].items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines += ['# TYPE ars_{} gauge'.format(name), 'ars_{} {}'.format(name, value)]
+
+        lines += [
+            '# HELP ars_migration_seconds Duration of the migration tasks of the last cycle.',
+            '# TYPE ars_migration_seconds summary',
+            'ars_migration_seconds_sum {}'.format(sum(durations)),
+            'ars_migration_seconds_count {}'.format(len(durations)),
+            '# TYPE ars_last_cycle_timestamp_seconds gauge',
+            'ars_last_cycle_timestamp_seconds {}'.format(self.timestamp),
+        ]
+
+        # the collector must never read a partially written file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def export(self, cfg):
+        if cfg.metrics.json_file:
+            self.write_json_lines(cfg.metrics.json_file)
+        if cfg.metrics.prometheus_file:
+            self.write_prometheus(cfg.metrics.prometheus_file)
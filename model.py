@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0
 
 import math
-from typing import List
+from typing import List, Optional
 from enum import Enum
 from dataclasses import dataclass
 
@@ -20,6 +20,14 @@ class VirtualMachine:
     state: str
     locked: bool
 
+    # demand over the usage history, if known, instead of the current usage
+    cpu_demand: Optional[float] = None
+    memory_demand: Optional[int] = None
+
+    # size of all disks, copied along with local disks on migration
+    disk_max: int = 0
+    # migration cost predicted from past migrations, if known
+    migration_estimate: Optional[int] = None
 
     # TODO:
     # - running_cost()
@@ -27,12 +35,14 @@ class VirtualMachine:
 
     def memory_cost(self):
         if self.state == 'running':
-            return self.memory_used
+            return self.memory_used if self.memory_demand is None else self.memory_demand
         else:
             # TODO: handle costs of stopped VMs better
             return self.memory_max // 10
 
     def migration_cost(self):
+        if self.migration_estimate is not None:
+            return self.migration_estimate
         if self.state == 'running':
             return (self.memory_used // 1024**2)
         else:
@@ -43,7 +53,7 @@ class VirtualMachine:
 
     def cpu_cost(self):
         if self.state == 'running':
-            return math.ceil(self.cpu_used * 100)
+            return math.ceil((self.cpu_used if self.cpu_demand is None else self.cpu_demand) * 100)
         else:
             # TODO: handle costs of stopped VMs better
             # to get deterministic placing *some* cost must be assigned to stopped VMs